@@ -0,0 +1,90 @@
+# 接続の受け入れ制御とレート制限
+#
+# ワーカー全体の接続数に上限を設け、超えたら新しい接続を断る。メッセージは
+# 接続ごとと送信元 IP ごとのトークンバケットの両方を通ったものだけを処理する
+# （1 つの IP から接続を増やしても IP ごとの枠は増えない）。新しい接続も IP の枠を 1 つ使う。
+# プロキシの後ろで動かすときは uvicorn の --proxy-headers で client を実際の IP にすること。
+
+import time
+from collections import OrderedDict
+
+# 覚えておく IP ごとのバケットの上限。超えたら最後に接続してから最も長い IP のものから捨てる
+MAX_TRACKED_IPS = 10_000
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate        # 1 秒あたりに回復するトークン数
+        self.burst = burst      # 溜められる上限
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now=None, cost=1):
+        # トークンがあれば cost だけ使って True
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class ClientLimits:
+    # 1 接続ぶんのレート制限。strikes は続けて制限にかかった回数
+    __slots__ = ("bucket", "ip_bucket", "strikes")
+
+    def __init__(self, bucket, ip_bucket):
+        self.bucket = bucket
+        self.ip_bucket = ip_bucket
+        self.strikes = 0
+
+    def allow(self):
+        now = time.monotonic()
+        # 接続の枠が尽きているときは IP の枠を減らさない
+        if self.bucket.take(now) and self.ip_bucket.take(now):
+            self.strikes = 0
+            return True
+        self.strikes += 1
+        return False
+
+
+class Admission:
+    def __init__(self, max_connections, rate, burst, ip_rate, ip_burst):
+        self.max_connections = max_connections
+        self.rate = rate
+        self.burst = burst
+        self.ip_rate = ip_rate
+        self.ip_burst = ip_burst
+        self.active = 0
+        self._ips = OrderedDict()   # 接続の古い順
+
+    def _ip_bucket(self, ip, now):
+        # 接続中の ClientLimits は自分のバケットを持ち続けるので、捨てても制限は効いたまま
+        bucket = self._ips.get(ip)
+        if bucket is None:
+            if len(self._ips) >= MAX_TRACKED_IPS:
+                self._ips.popitem(last=False)
+            bucket = self._ips[ip] = TokenBucket(self.ip_rate, self.ip_burst, now)
+        else:
+            self._ips.move_to_end(ip)
+        return bucket
+
+    def admit(self, ip):
+        # (ClientLimits, None) か、断るなら (None, 理由 "capacity" / "ip_rate")。
+        # 受け入れた接続は終わったら release() すること
+        if self.active >= self.max_connections:
+            return None, "capacity"
+        now = time.monotonic()
+        ip_bucket = self._ip_bucket(ip, now)
+        if not ip_bucket.take(now):
+            return None, "ip_rate"
+        self.active += 1
+        return ClientLimits(TokenBucket(self.rate, self.burst, now), ip_bucket), None
+
+    def release(self):
+        self.active -= 1
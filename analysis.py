@@ -0,0 +1,364 @@
+# 局面の一括解析（合法手・評価値・最善手）と、CPU 調整用の自己対局
+#
+# 局面は NumPy の uint64 配列にまとめ、着手生成と静的評価（cpu.evaluate と同じ値）は
+# 局面方向にベクトル化して一度に計算する。最善手の探索は局面ごとに独立なので、
+# チャンクに分けて専用のプロセスプールで全コアに配る（対局中の CPU 用の cpu_pool とは別の
+# プールだが、同じマシンで動かせばコアは取り合う。大きな解析は別のデプロイで動かすこと）。
+#
+#   POST /analysis（server.py）と同じ JSON を CLI からも渡せる:
+#   python analysis.py analyze request.json --output result.json
+#   python analysis.py selfplay --games 200 --black alphabeta:4 --white greedy
+#
+# リクエスト: {"positions": [{"board": <packed 文字列 または 8x8 リスト>, "turn": "black"}, ...],
+#              "records": [<棋譜文字列 "b..."> または {"first_turn": "black", "moves": [[x, y], null, ...]}],
+#              "level": "alphabeta:4", "time_budget": 0.1}
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+
+import cpu
+import engine
+import movelog
+
+DEFAULT_LEVEL = "alphabeta:4"
+DEFAULT_TIME_BUDGET = 0.1
+MAX_TIME_BUDGET = 5.0
+# 1 回にワーカーへ渡す局面数の上限（小さいほど負荷が均等になり、大きいほど NumPy が効く）
+CHUNK_SIZE = 256
+
+COLORS = {"black": engine.BLACK, "white": engine.WHITE}
+COLOR_NAMES = {engine.BLACK: "black", engine.WHITE: "white"}
+
+_DIRECTIONS = tuple((np.uint64(abs(d)), d > 0, np.uint64(mask)) for d, mask in engine.DIRECTIONS)
+_WEIGHT_MASKS = tuple((w, np.uint64(mask)) for w, mask in cpu.WEIGHT_MASKS)
+_FULL = np.uint64(engine.FULL)
+
+
+def _shift(bits, amount, left, mask):
+    # engine.shift の配列版（uint64 なので左シフトではみ出したビットは落ちる）
+    return ((bits << amount) if left else (bits >> amount)) & mask
+
+
+def batch_legal_moves(players, opponents):
+    # 各局面の手番側 players[i] が打てるマスのビット集合（engine.legal_moves と同じ）
+    empty = ~(players | opponents) & _FULL
+    moves = np.zeros_like(players)
+    for amount, left, mask in _DIRECTIONS:
+        t = _shift(players, amount, left, mask) & opponents
+        for _ in range(5):
+            t |= _shift(t, amount, left, mask) & opponents
+        moves |= _shift(t, amount, left, mask) & empty
+    return moves
+
+
+def _popcount(bits):
+    return np.bitwise_count(bits).astype(np.int64)
+
+
+def batch_evaluate(players, opponents, moves=None):
+    # 手番側から見た評価値（cpu.evaluate と同じ値）。moves は手番側の合法手（計算済みなら渡す）
+    if moves is None:
+        moves = batch_legal_moves(players, opponents)
+    score = np.zeros(len(players), dtype=np.int64)
+    for w, mask in _WEIGHT_MASKS:
+        score += w * (_popcount(players & mask) - _popcount(opponents & mask))
+    mobility = _popcount(moves) - _popcount(batch_legal_moves(opponents, players))
+    return score + cpu.MOBILITY_WEIGHT * mobility
+
+
+def analyze_chunk(positions, level, time_budget):
+    # ワーカー側。[(black, white, 手番), ...] ごとに (合法手, 評価値, 最善手のマス or None)
+    blacks = np.array([p[0] for p in positions], dtype=np.uint64)
+    whites = np.array([p[1] for p in positions], dtype=np.uint64)
+    is_black = np.array([p[2] == engine.BLACK for p in positions])
+    players = np.where(is_black, blacks, whites)
+    opponents = np.where(is_black, whites, blacks)
+    legal = batch_legal_moves(players, opponents)
+    scores = batch_evaluate(players, opponents, legal)
+
+    results = []
+    for (black, white, color), moves, score in zip(positions, legal.tolist(), scores.tolist()):
+        best = cpu.worker_choose_move(black, white, color, moves, level, time_budget) if moves else None
+        results.append((moves, score, best))
+    return results
+
+
+def play_game(black_level, white_level, time_budget, opening_plies, seed):
+    # ワーカー側。最初の opening_plies 手はランダムに打ち、あとは各 level で終局まで打つ。
+    # (棋譜, 黒の石数, 白の石数)
+    rng = random.Random(seed)
+    levels = {engine.BLACK: black_level, engine.WHITE: white_level}
+    black, white = engine.initial()
+    color = engine.BLACK
+    legal = engine.legal_moves(black, white)
+    log = []
+    while legal:
+        if len(log) < opening_plies:
+            sq = rng.choice(list(engine.iter_squares(legal)))
+        else:
+            sq = cpu.worker_choose_move(black, white, color, legal, levels[color], time_budget)
+        entry = movelog.encode(sq)
+        black, white, color, legal = movelog.step(black, white, color, entry)
+        log.append(entry)
+    return movelog.header(engine.BLACK) + "".join(log), black.bit_count(), white.bit_count()
+
+
+def parse_level(level):
+    # "greedy" / "alphabeta:6" などを cpu の表記に正規化する（知らない強さは ValueError）
+    if level is None or level == "":
+        level = DEFAULT_LEVEL
+    if not isinstance(level, str):
+        raise ValueError(f"invalid level: {level!r}")
+    kind, sep, depth = level.partition(":")
+    if kind not in cpu.LEVELS or (sep and (kind != "alphabeta" or not depth.isdigit())):
+        raise ValueError(f"invalid level: {level!r}")
+    return cpu.parse_level(f"cpu:{level}")
+
+
+def parse_position(item):
+    # {"board": ..., "turn": ...} から (black, white, 手番)
+    if not isinstance(item, dict) or "board" not in item:
+        raise ValueError("position must be an object with a board")
+    board = item["board"]
+    if isinstance(board, str):
+        try:
+            data = base64.b64decode(board, validate=True)
+        except Exception:
+            data = b""
+        if len(data) != 16:
+            raise ValueError("board is not a packed board")
+        black, white = engine.unpack(data)
+    elif isinstance(board, list) and len(board) == 8 and all(
+            isinstance(row, list) and len(row) == 8 for row in board):
+        black, white = engine.from_list(board)
+    else:
+        raise ValueError("board must be a packed string or an 8x8 list")
+    if black & white:
+        raise ValueError("board has overlapping stones")
+    turn = item.get("turn", "black")
+    if not isinstance(turn, str) or turn not in COLORS:
+        raise ValueError(f"invalid turn: {turn!r}")
+    return black, white, COLORS[turn]
+
+
+def parse_record(item):
+    # 棋譜を再生し、各手数の局面 [(black, white, 手番), ...]（終局面を含む）と
+    # 実際に打たれた手 [[x, y] or None, ...] を返す
+    if isinstance(item, str):
+        if item[:movelog.HEADER] not in ("b", "w"):
+            raise ValueError("record must start with 'b' or 'w'")
+        first, log = movelog.parse(item)
+    elif isinstance(item, dict) and isinstance(item.get("moves"), list):
+        first_turn = item.get("first_turn", "black")
+        if not isinstance(first_turn, str) or first_turn not in COLORS:
+            raise ValueError(f"invalid first_turn: {first_turn!r}")
+        first = COLORS[first_turn]
+        log = ""
+        for move in item["moves"]:
+            if move is None:
+                log += movelog.PASS
+            elif (isinstance(move, list) and len(move) == 2
+                  and all(isinstance(v, int) and 0 <= v < 8 for v in move)):
+                log += movelog.encode(engine.square(*move))
+            else:
+                raise ValueError(f"invalid move: {move}")
+    else:
+        raise ValueError("record must be a move log string or an object with moves")
+
+    black, white = engine.initial()
+    color = first
+    positions = [(black, white, color)]
+    for ply, entry in enumerate(log):
+        sq = movelog.decode(entry)
+        if sq is not None and not 0 <= sq < 64:
+            raise ValueError(f"invalid move at ply {ply}")
+        try:
+            black, white, color, _ = movelog.step(black, white, color, entry)
+        except ValueError:
+            raise ValueError(f"illegal move at ply {ply}")
+        positions.append((black, white, color))
+    return positions, movelog.moves(log)
+
+
+def parse_request(data, max_positions, max_search_seconds=None):
+    # リクエスト全体を解析し、(全局面, 棋譜ごとの実際の手, level, time_budget) を返す。
+    # 全局面は positions の後に棋譜ごとの局面を順に並べたもの。
+    # max_search_seconds は 局面数 × time_budget（探索にかかる CPU 時間の上限）の上限
+    if not isinstance(data, dict):
+        raise ValueError("request must be an object")
+    positions = [parse_position(item) for item in data.get("positions") or []]
+    records = []
+    for item in data.get("records") or []:
+        record_positions, played = parse_record(item)
+        positions += record_positions
+        records.append(played)
+    if len(positions) > max_positions:
+        raise ValueError(f"too many positions ({len(positions)} > {max_positions})")
+    try:
+        time_budget = float(data.get("time_budget", DEFAULT_TIME_BUDGET))
+    except (TypeError, ValueError):
+        raise ValueError("time_budget must be a number")
+    time_budget = min(max(time_budget, 0.001), MAX_TIME_BUDGET)
+    if max_search_seconds is not None and len(positions) * time_budget > max_search_seconds:
+        raise ValueError(f"too much search ({len(positions)} positions x {time_budget}s > "
+                         f"{max_search_seconds}s); send fewer positions or a smaller time_budget")
+    return positions, records, parse_level(data.get("level")), time_budget
+
+
+def position_result(position, result):
+    black, white, color = position
+    moves, score, best = result
+    return {
+        "turn": COLOR_NAMES[color],
+        "legal_moves": [list(engine.coords(sq)) for sq in engine.iter_squares(moves)],
+        "evaluation": score,
+        "best_move": None if best is None else list(engine.coords(best)),
+        "black": black.bit_count(),
+        "white": white.bit_count(),
+    }
+
+
+def format_response(positions, records, level, results):
+    # parse_request の並びに戻す。棋譜の各局面には手数と実際に打たれた手を付ける
+    output = [position_result(p, r) for p, r in zip(positions, results)]
+    start = len(output) - sum(len(played) + 1 for played in records)
+    response = {"level": level, "positions": output[:start], "records": []}
+    for played in records:
+        entries = output[start:start + len(played) + 1]
+        for ply, entry in enumerate(entries):
+            entry["ply"] = ply
+            if ply < len(played):
+                entry["played"] = played[ply]
+        response["records"].append({"positions": entries})
+        start += len(played) + 1
+    return response
+
+
+class Analyzer:
+    # 解析・自己対局用のプロセスプール。既定では全コアを使う
+    def __init__(self, workers=None, tt_size=200_000, chunk_size=CHUNK_SIZE):
+        self.workers = workers or os.cpu_count() or 1
+        self.tt_size = tt_size
+        self.chunk_size = chunk_size
+        self._executor = None
+
+    def _get_executor(self):
+        # 最初の解析でワーカーを立ち上げる
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=cpu.init_worker,
+                initargs=(self.tt_size,),
+            )
+        return self._executor
+
+    def _chunks(self, positions):
+        # ワーカー数の 4 倍程度に分け、探索の重い局面が 1 つのワーカーに偏らないようにする
+        size = max(1, min(self.chunk_size, math.ceil(len(positions) / (self.workers * 4))))
+        return [positions[i:i + size] for i in range(0, len(positions), size)]
+
+    def _submit(self, positions, level, time_budget):
+        executor = self._get_executor()
+        return [executor.submit(analyze_chunk, chunk, level, time_budget)
+                for chunk in self._chunks(positions)]
+
+    async def analyze(self, positions, level, time_budget):
+        # イベントループを止めずに解析する。結果は positions と同じ順
+        futures = self._submit(positions, level, time_budget)
+        chunks = await asyncio.gather(*(asyncio.wrap_future(f) for f in futures))
+        return [result for chunk in chunks for result in chunk]
+
+    def analyze_sync(self, positions, level, time_budget):
+        return [result for f in self._submit(positions, level, time_budget) for result in f.result()]
+
+    def selfplay(self, games, black_level, white_level, time_budget, opening_plies, seed):
+        # 同じ seed なら同じ序盤から始まる（level を入れ替えて比べられる）
+        rng = random.Random(seed)
+        seeds = [rng.getrandbits(32) for _ in range(games)]
+        return list(self._get_executor().map(
+            play_game, repeat(black_level), repeat(white_level), repeat(time_budget),
+            repeat(opening_plies), seeds))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Othello batch analysis and self-play")
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: all cores)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    a = sub.add_parser("analyze")
+    a.add_argument("request", help="request JSON file (- for stdin)")
+    a.add_argument("--level", help="overrides the request's level")
+    a.add_argument("--time-budget", type=float, help="overrides the request's time_budget")
+    a.add_argument("--output")
+    s = sub.add_parser("selfplay")
+    s.add_argument("--games", type=int, default=100)
+    s.add_argument("--black", default=DEFAULT_LEVEL)
+    s.add_argument("--white", default="greedy")
+    s.add_argument("--time-budget", type=float, default=DEFAULT_TIME_BUDGET)
+    s.add_argument("--opening-plies", type=int, default=4, help="random moves before the levels play")
+    s.add_argument("--seed", type=int, default=1)
+    s.add_argument("--output", help="write one move log per line")
+    args = parser.parse_args()
+
+    analyzer = Analyzer(args.workers)
+    start = time.perf_counter()
+    try:
+        if args.command == "analyze":
+            with (sys.stdin if args.request == "-" else open(args.request)) as f:
+                data = json.load(f)
+            if args.level:
+                data["level"] = args.level
+            if args.time_budget is not None:
+                data["time_budget"] = args.time_budget
+            positions, records, level, time_budget = parse_request(data, max_positions=sys.maxsize)
+            results = analyzer.analyze_sync(positions, level, time_budget)
+            text = json.dumps(format_response(positions, records, level, results))
+            if args.output:
+                with open(args.output, "w") as f:
+                    f.write(text + "\n")
+            else:
+                print(text)
+            logging.info(f"[ANALYSIS] {len(positions)} 局面を {time.perf_counter() - start:.2f} 秒で解析しました"
+                         f"（{analyzer.workers} プロセス）")
+
+        elif args.command == "selfplay":
+            black, white = parse_level(args.black), parse_level(args.white)
+            games = analyzer.selfplay(args.games, black, white, args.time_budget,
+                                      args.opening_plies, args.seed)
+            seconds = time.perf_counter() - start
+            wins = sum(b > w for _, b, w in games)
+            losses = sum(b < w for _, b, w in games)
+            diff = sum(b - w for _, b, w in games) / max(1, len(games))
+            print(f"black {black} vs white {white}: {wins} wins, {losses} losses, "
+                  f"{len(games) - wins - losses} draws, mean disc diff {diff:+.2f} "
+                  f"({len(games) / seconds:.2f} games/s on {analyzer.workers} processes)")
+            if args.output:
+                with open(args.output, "w") as f:
+                    f.writelines(record + "\n" for record, _, _ in games)
+    except ValueError as e:
+        parser.error(str(e))
+    finally:
+        analyzer.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# ベンチマーク共通：Redis の用意と集計
+#
+# server をインポートする前に setup_redis() を呼ぶこと（server は読み込み時に接続を作る）。
+# --redis-url を指定すればその Redis（ローカルの redis-server など）を、
+# 指定しなければ fakeredis をプロセス内で使う（pip install -r bench/requirements.txt）。
+
+import os
+import time
+
+# 送信したコマンド列（パイプラインは 1 回）を数える
+round_trips = 0
+
+
+def setup_redis(redis_url=None):
+    import redis.asyncio
+    from redis.asyncio.connection import AbstractConnection
+
+    if redis_url:
+        os.environ["REDIS_URL"] = redis_url
+    else:
+        import fakeredis
+        fake_server = fakeredis.FakeServer()
+        redis.asyncio.from_url = lambda url, **kwargs: fakeredis.FakeAsyncRedis(
+            server=fake_server, **kwargs)
+        os.environ["REDIS_URL"] = "redis://fakeredis"
+
+    send = AbstractConnection.send_packed_command
+
+    async def counting_send(self, command, check_health=True):
+        global round_trips
+        round_trips += 1
+        return await send(self, command, check_health)
+
+    AbstractConnection.send_packed_command = counting_send
+
+
+async def commands_processed(rdb):
+    # サーバー側で処理したコマンド数（INFO に対応していなければ None）
+    try:
+        return int((await rdb.info("stats"))["total_commands_processed"])
+    except Exception:
+        return None
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class Timer:
+    def __init__(self):
+        self.start = time.perf_counter()
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+
+def report(lines, output=None):
+    text = "\n".join(lines) + "\n"
+    print(text, end="")
+    if output:
+        with open(output, "a") as f:
+            f.write(text)
@@ -0,0 +1,194 @@
+# 負荷試験：server.app をプロセス内で起動し、模擬クライアントを実際のプロトコルで動かす
+#
+#   python -m bench.load --clients 200 --cpu-clients 20 --reconnect 0.1 --surrender 0.05
+#   python -m bench.load --redis-url redis://localhost:6379/15 --output bench_output.txt
+#
+# 対人戦のクライアントは register → start_game → move（合法手からランダム）→ end_game を、
+# 一部は途中で降参（surrender）・切断して ply 付きで再接続する。CPU 戦も同時に流す。
+# メッセージの種類ごとに、送信から応答（自分の手の move 通知など）までの p50 / p99 と、
+# 全体のスループット、1 手あたりの Redis の往復数・コマンド数を出力する。
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import time
+from collections import defaultdict
+
+from bench import common
+
+
+class Stats:
+    def __init__(self):
+        self.latency = defaultdict(list)
+        self.moves = 0
+        self.games = 0
+        self.errors = 0
+
+    def observe(self, kind, seconds):
+        self.latency[kind].append(seconds)
+
+    def finish(self, mode):
+        # 対人戦は両方のクライアントが数えるので半局ずつ
+        self.games += 1 if mode != "online" else 0.5
+
+
+async def receive(ws, timeout):
+    return json.loads(await asyncio.wait_for(ws.recv(), timeout))
+
+
+async def play(uri, user_id, mode, stats, args, rng):
+    import websockets
+
+    register = {"type": "register", "user_id": user_id, "name": user_id, "mode": mode,
+                "board_format": "packed"}
+    reconnected = False
+    ply = 0
+    ws = await websockets.connect(uri)
+    try:
+        sent = time.perf_counter()
+        await ws.send(json.dumps(register))
+        frame = await receive(ws, args.timeout)
+        while frame.get("type") != "start_game":
+            frame = await receive(ws, args.timeout)
+        stats.observe("start_game" if mode == "cpu" else "matchmaking", time.perf_counter() - sent)
+        color = frame["your_color"]
+        my_turn = frame["first_turn"] == color
+        legal = frame["legal_moves"]
+        surrender_at = rng.randrange(4, 40) if rng.random() < args.surrender else None
+        reconnect_at = rng.randrange(4, 40) if rng.random() < args.reconnect else None
+
+        while True:
+            if my_turn and legal:
+                if surrender_at is not None and ply >= surrender_at:
+                    # 降参した側には応答が来ないので、処理時間は測らない
+                    await ws.send(json.dumps({"type": "surrender", "user_id": user_id}))
+                    stats.finish(mode)
+                    return
+                if reconnect_at is not None and ply >= reconnect_at and not reconnected:
+                    # 切断して、処理されるのを待ってから何手目まで知っているかを付けて再接続
+                    reconnected = True
+                    await ws.close()
+                    await asyncio.sleep(args.reconnect_delay)
+                    ws = await websockets.connect(uri)
+                    sent = time.perf_counter()
+                    await ws.send(json.dumps({**register, "ply": ply}))
+                    frame = await receive(ws, args.timeout)
+                    while frame.get("type") not in ("restore_moves", "restore_board"):
+                        frame = await receive(ws, args.timeout)
+                    stats.observe(frame["type"], time.perf_counter() - sent)
+                    ply = frame["ply"]
+                    my_turn = frame["your_turn"]
+                    legal = frame["legal_moves"]
+                    continue
+
+                x, y = rng.choice(legal)
+                sent = time.perf_counter()
+                await ws.send(json.dumps({"type": "move", "x": x, "y": y}))
+                my_turn = False
+                # 自分の手の move 通知が届くまでを 1 手の処理時間とする
+                while True:
+                    frame = await receive(ws, args.timeout)
+                    if frame.get("type") == "move" and frame["color"] == color:
+                        stats.observe("move", time.perf_counter() - sent)
+                        stats.moves += 1
+                        break
+                    if frame.get("type") in ("error", "end_game", "opponent_surrendered"):
+                        break
+            else:
+                frame = await receive(ws, args.timeout)
+
+            kind = frame.get("type")
+            if kind in ("move", "pass"):
+                ply = frame.get("ply", ply)
+                my_turn = frame["your_turn"]
+                legal = frame["legal_moves"]
+                if kind == "move" and frame["color"] != color and mode == "cpu":
+                    stats.moves += 1
+            elif kind in ("end_game", "opponent_surrendered"):
+                stats.finish(mode)
+                return
+            elif kind == "error":
+                stats.errors += 1
+                my_turn = False
+    except (asyncio.TimeoutError, OSError):
+        stats.errors += 1
+        stats.observe("timeout", args.timeout)
+    finally:
+        await ws.close()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def main(args):
+    common.setup_redis(args.redis_url)
+    # 模擬クライアントは全員 127.0.0.1 から人より速く打つので、レート制限は外す
+    for name in ("MESSAGE_RATE", "MESSAGE_BURST", "IP_MESSAGE_RATE", "IP_MESSAGE_BURST"):
+        os.environ.setdefault(name, "1000000000")
+    import uvicorn
+    import server
+
+    port = free_port()
+    config = uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning")
+    uvicorn_server = uvicorn.Server(config)
+    serving = asyncio.create_task(uvicorn_server.serve())
+    while not uvicorn_server.started:
+        await asyncio.sleep(0.05)
+
+    uri = f"ws://127.0.0.1:{port}/ws"
+    rng = random.Random(args.seed)
+    # 前回の実行の user ハッシュと混ざらないよう、実行ごとに別の user_id を使う
+    run = int(time.time())
+    stats = Stats()
+    commands_before = await common.commands_processed(server.rdb)
+    trips_before = common.round_trips
+    elapsed = common.Timer()
+
+    clients = [play(uri, f"bench-{run}-{i}", "online", stats, args, random.Random(rng.random()))
+               for i in range(args.clients - args.clients % 2)]
+    clients += [play(uri, f"bench-{run}-cpu-{i}", f"cpu:{args.cpu_level}", stats, args,
+                     random.Random(rng.random()))
+                for i in range(args.cpu_clients)]
+    await asyncio.gather(*clients)
+
+    seconds = elapsed.elapsed()
+    commands_after = await common.commands_processed(server.rdb)
+    trips = common.round_trips - trips_before
+    uvicorn_server.should_exit = True
+    await serving
+
+    per_move = lambda n: f"{n / stats.moves:.2f}" if stats.moves and n else "n/a"
+    lines = [
+        f"# bench.load clients={args.clients} cpu_clients={args.cpu_clients} "
+        f"redis={'url' if args.redis_url else 'fakeredis'} seed={args.seed}",
+        f"elapsed {seconds:.2f}s  games {stats.games:g}  moves {stats.moves}  errors {stats.errors}",
+        f"throughput {stats.moves / seconds:.1f} moves/s  {stats.games / seconds:.1f} games/s",
+        f"redis round trips/move {per_move(trips)}  commands/move "
+        f"{per_move(commands_after - commands_before) if commands_before is not None else 'n/a'}",
+        f"{'type':<14}{'n':>7}{'p50 ms':>10}{'p99 ms':>10}",
+    ]
+    for kind, values in sorted(stats.latency.items()):
+        lines.append(f"{kind:<14}{len(values):>7}{common.percentile(values, 50) * 1000:>10.2f}"
+                     f"{common.percentile(values, 99) * 1000:>10.2f}")
+    common.report(lines, args.output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Othello server load benchmark")
+    parser.add_argument("--clients", type=int, default=100, help="online players (even)")
+    parser.add_argument("--cpu-clients", type=int, default=10)
+    parser.add_argument("--cpu-level", default="greedy")
+    parser.add_argument("--reconnect", type=float, default=0.1, help="fraction that reconnects")
+    parser.add_argument("--reconnect-delay", type=float, default=0.2)
+    parser.add_argument("--surrender", type=float, default=0.05, help="fraction that surrenders")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--redis-url")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,147 @@
+# マイクロベンチマーク：着手生成・評価・探索と、マッチング（待機 10 / 1k / 10k 人）
+#
+#   python -m bench.micro                    # 盤面まわりだけ（Redis 不要）
+#   python -m bench.micro --match            # マッチングも（fakeredis）
+#   python -m bench.micro --match --redis-url redis://localhost:6379/15 --output bench_output.txt
+#
+# 結果は 1 回あたりの時間（µs）で出すので、変更前後で比べて遅くなっていないかを確かめる。
+
+import argparse
+import asyncio
+import logging
+import random
+import time
+import timeit
+
+from bench import common
+
+
+def random_positions(n, seed):
+    # ランダム対局の途中局面 (black, white, 手番の色, 合法手) を n 個
+    import engine
+
+    rng = random.Random(seed)
+    positions = []
+    while len(positions) < n:
+        black, white = engine.initial()
+        color = engine.BLACK
+        legal = engine.legal_moves(*engine.split(black, white, color))
+        while legal:
+            positions.append((black, white, color, legal))
+            sq = rng.choice(list(engine.iter_squares(legal)))
+            player, opponent = engine.play(*engine.split(black, white, color), sq)
+            black, white = engine.join(player, opponent, color)
+            color, legal = engine.advance(black, white, color)
+    return positions[:n]
+
+
+def measure(name, fn, positions, repeat=5):
+    # positions の全局面に fn を 1 回ずつ適用する時間の最小値から、1 局面あたりの µs
+    best = min(timeit.repeat(lambda: [fn(*p) for p in positions], number=1, repeat=repeat))
+    return f"{name:<28}{best / len(positions) * 1e6:>10.2f} µs"
+
+
+def engine_benchmarks(seed):
+    import cpu
+    import engine
+    import movelog
+
+    positions = random_positions(2000, seed)
+    first_move = lambda legal: (legal & -legal).bit_length() - 1
+
+    def play(black, white, color, legal):
+        return engine.play(*engine.split(black, white, color), first_move(legal))
+
+    def position_play(black, white, color, legal):
+        return engine.Position.from_colors(black, white, color).play(first_move(legal))
+
+    def list_roundtrip(black, white, color, legal):
+        return engine.from_list(engine.to_list(black, white))
+
+    lines = [
+        f"# bench.micro engine positions={len(positions)} seed={seed}",
+        measure("legal_moves", lambda b, w, c, l: engine.legal_moves(*engine.split(b, w, c)), positions),
+        measure("play (place_stone)", play, positions),
+        measure("Position.play", position_play, positions),
+        measure("advance", lambda b, w, c, l: engine.advance(b, w, c), positions),
+        measure("evaluate", lambda b, w, c, l: cpu.evaluate(*engine.split(b, w, c)), positions),
+        measure("to_list/from_list", list_roundtrip, positions),
+        measure("pack/unpack", lambda b, w, c, l: engine.unpack(engine.pack(b, w)), positions),
+    ]
+
+    # 1 局ぶんの棋譜の再生
+    rng = random.Random(seed)
+    black, white = engine.initial()
+    color, legal, log = engine.BLACK, engine.legal_moves(black, white), ""
+    while legal:
+        entry = movelog.encode(rng.choice(list(engine.iter_squares(legal))))
+        black, white, color, legal = movelog.step(black, white, color, entry)
+        log += entry
+    best = min(timeit.repeat(lambda: movelog.replay(log), number=100, repeat=5)) / 100
+    lines.append(f"{'movelog.replay (' + str(len(log)) + ' plies)':<28}{best * 1e6:>10.2f} µs")
+
+    # 中盤の局面を深さ 4 で探索したときの 1 秒あたりのノード数
+    nodes = seconds = 0
+    for black, white, color, legal in positions[20:2000:200]:
+        search = cpu.AlphaBeta(cpu.TranspositionTable(), time.monotonic() + 10)
+        start = time.perf_counter()
+        search.search(engine.Position.from_colors(black, white, color), color, 4)
+        seconds += time.perf_counter() - start
+        nodes += search.nodes
+    lines.append(f"{'alphabeta depth 4':<28}{nodes / seconds:>10.0f} nodes/s")
+    return lines
+
+
+async def match_benchmarks(args):
+    common.setup_redis(args.redis_url)
+    import server
+
+    logging.disable(logging.WARNING)   # 接続していない待機者への start_game の警告を抑える
+    rng = random.Random(args.seed)
+    lines = [f"# bench.micro match redis={'url' if args.redis_url else 'fakeredis'} "
+             f"batch={server.MATCH_BATCH_SIZE}"]
+    for waiting in (10, 1_000, 10_000):
+        mode = f"bench-{int(time.time())}-{waiting}"
+        key = server.queue_key(mode)
+        now = time.time()
+        async with server.rdb.pipeline(transaction=False) as pipe:
+            for i in range(waiting):
+                uid = f"{mode}-{i}"
+                pipe.hset(f"user:{uid}", mapping={"name": uid, "status": "waiting", "mode": mode})
+                pipe.zadd(key, {uid: now - rng.uniform(0, 30)})
+                pipe.zadd(f"{key}:rating", {uid: rng.gauss(1500, 200)})
+            await pipe.execute()
+
+        start = time.perf_counter()
+        first = await server.match_batch(mode)
+        first_seconds = time.perf_counter() - start
+        pairs = first
+        while True:
+            made = await server.match_batch(mode)
+            pairs += made
+            if made < server.MATCH_BATCH_SIZE:
+                break
+        seconds = time.perf_counter() - start
+        left = await server.rdb.zcard(key)
+        lines.append(f"match_batch waiting={waiting:<6} first batch {first_seconds * 1000:8.2f} ms "
+                     f"({first} pairs)  drain {seconds * 1000:9.2f} ms  "
+                     f"{pairs / seconds:8.0f} pairs/s  left {left}")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Othello server micro benchmarks")
+    parser.add_argument("--match", action="store_true", help="also benchmark matchmaking (needs Redis)")
+    parser.add_argument("--redis-url")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    lines = engine_benchmarks(args.seed)
+    if args.match:
+        lines += asyncio.run(match_benchmarks(args))
+    common.report(lines, args.output)
+
+
+if __name__ == "__main__":
+    main()
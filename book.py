@@ -0,0 +1,157 @@
+# 定石（オープニングブック）
+#
+# ファイルは 16 バイトのレコード（局面キー u64 + 着手 u8 + 詰め物）を
+# キーの昇順に並べたもので、mmap して二分探索で引く。
+# 局面は盤面の 8 通りの対称（回転・反転）で同一視し、最小になる向き
+# （正規形）のハッシュをキーに、着手も正規形の座標で保存する。
+#
+# 作成: python book.py build book.bin --plies 8 --depth 6
+
+import argparse
+import logging
+import mmap
+import os
+import struct
+import time
+
+import cpu
+import engine
+
+RECORD = struct.Struct("<QB7x")
+
+
+def _sym_square(s, sq):
+    # 対称変換 s（0..7）でマス sq が移る先
+    x, y = divmod(sq, 8)
+    if s & 1:
+        x = 7 - x
+    if s & 2:
+        y = 7 - y
+    if s & 4:
+        x, y = y, x
+    return x * 8 + y
+
+
+SYMMETRIES = range(8)
+PERMUTATIONS = tuple(tuple(_sym_square(s, sq) for sq in range(64)) for s in SYMMETRIES)
+INVERSES = tuple(
+    tuple(perm.index(sq) for sq in range(64)) for perm in PERMUTATIONS
+)
+# ビットボードを 1 バイトずつ変換するための表 [s][バイト位置][値]
+_BYTE_TABLES = tuple(
+    tuple(
+        tuple(
+            sum(1 << perm[i * 8 + b] for b in range(8) if v >> b & 1)
+            for v in range(256)
+        )
+        for i in range(8)
+    )
+    for perm in PERMUTATIONS
+)
+
+
+def transform(bits, s):
+    tables = _BYTE_TABLES[s]
+    out = 0
+    for i in range(8):
+        out |= tables[i][bits >> (i * 8) & 0xFF]
+    return out
+
+
+def canonical(player, opponent):
+    # 正規形の (キー, 対称変換 s)
+    best, best_s = None, 0
+    for s in SYMMETRIES:
+        pair = (transform(player, s), transform(opponent, s))
+        if best is None or pair < best:
+            best, best_s = pair, s
+    return cpu.zobrist(best[0], best[1], engine.BLACK), best_s
+
+
+class OpeningBook:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._size = len(self._mm) // RECORD.size
+
+    def __len__(self):
+        return self._size
+
+    def lookup(self, player, opponent):
+        # 手番側 player の定石手（マス番号）。なければ None
+        key, s = canonical(player, opponent)
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k, move = RECORD.unpack_from(self._mm, mid * RECORD.size)
+            if k < key:
+                lo = mid + 1
+            elif k > key:
+                hi = mid
+            else:
+                return INVERSES[s][move]
+        return None
+
+    def close(self):
+        self._mm.close()
+
+
+def load(path):
+    if not path or not os.path.exists(path) or os.path.getsize(path) == 0:
+        logging.info(f"[BOOK] 定石ファイル {path} がないため定石なしで起動します")
+        return None
+    book = OpeningBook(path)
+    logging.info(f"[BOOK] 定石 {len(book)} 局面を読み込みました（{path}）")
+    return book
+
+
+def build(path, plies, depth, time_budget):
+    # 初期局面から plies 手目までの全局面について、探索した最善手を登録する
+    table = cpu.TranspositionTable()
+    records = {}
+    frontier = [(engine.Position(*engine.initial()), engine.BLACK)]
+    for ply in range(plies):
+        next_frontier = []
+        for position, color in frontier:
+            moves = position.moves()
+            if not moves:
+                position, color = position.pass_turn(), -color
+                moves = position.moves()
+                if not moves:
+                    continue
+            key, s = canonical(position.player, position.opponent)
+            if key in records:
+                continue
+            search = cpu.AlphaBeta(table, time.monotonic() + time_budget)
+            sq = search.search(position, color, depth)
+            records[key] = PERMUTATIONS[s][sq]
+            for sq in engine.iter_squares(moves):
+                next_frontier.append((position.play(sq), -color))
+        frontier = next_frontier
+        logging.info(f"[BOOK] {ply + 1} 手目まで: {len(records)} 局面")
+
+    with open(path, "wb") as f:
+        for key in sorted(records):
+            f.write(RECORD.pack(key, records[key]))
+    return len(records)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Othello opening book")
+    sub = parser.add_subparsers(dest="command", required=True)
+    b = sub.add_parser("build")
+    b.add_argument("path")
+    b.add_argument("--plies", type=int, default=8)
+    b.add_argument("--depth", type=int, default=6)
+    b.add_argument("--time-budget", type=float, default=2.0)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        n = build(args.path, args.plies, args.depth, args.time_budget)
+        print(f"{n} positions written to {args.path}")
+
+
+if __name__ == "__main__":
+    main()
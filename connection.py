@@ -0,0 +1,95 @@
+# 接続ごとの送信キュー
+#
+# 送信は send() でキューに積むだけで待たず、接続ごとの writer タスクが順番に
+# WebSocket へ書き出す。遅いクライアントがいても送信側や他のプレイヤーは
+# 止まらない。キューが上限を超えた接続は閉じる（受信ループ側で切断として処理される）。
+
+import asyncio
+import json
+import logging
+from collections import deque
+
+# 未送信のまま後続のフレームで置き換えてよい種類（盤面全体を送るもの）
+COALESCE = frozenset({"update_board"})
+# 送信キューに積む「ここまで送ったら閉じる」印
+_CLOSE = object()
+
+
+class Connection:
+    def __init__(self, websocket, max_queue=256):
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.closed = False
+        self._queue = deque()
+        self._ready = asyncio.Event()
+        self._writer = asyncio.create_task(self._run())
+
+    def __len__(self):
+        return len(self._queue)
+
+    def send(self, frame):
+        # frame（dict）を送信キューに積む。閉じていれば False
+        return self.send_text(json.dumps(frame), frame.get("type"))
+
+    def send_text(self, text, kind=None):
+        # シリアライズ済みのフレームを積む（観戦者への一斉送信は同じ文字列を共有する）
+        if self.closed:
+            return False
+        if kind in COALESCE and self._queue and self._queue[-1][0] == kind:
+            # 末尾の未送信の盤面は古いので置き換える
+            self._queue[-1] = (kind, text)
+            return True
+        if len(self._queue) >= self.max_queue:
+            logging.warning(f"[SEND] 送信キューが上限（{self.max_queue}）を超えたため接続を閉じます")
+            self._abort(code=1008)
+            return False
+        self._queue.append((kind, text))
+        self._ready.set()
+        return True
+
+    async def _run(self):
+        try:
+            while True:
+                while not self._queue:
+                    self._ready.clear()
+                    await self._ready.wait()
+                kind, text = self._queue.popleft()
+                if kind is _CLOSE:
+                    await self.websocket.close(code=text)
+                    return
+                await self.websocket.send_text(text)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.info(f"[SEND] 送信に失敗したため送信キューを止めます: {e}")
+            self.closed = True
+            self._queue.clear()
+
+    def _abort(self, code):
+        self.closed = True
+        self._queue.clear()
+        self._writer.cancel()
+        asyncio.create_task(self._close_socket(code))
+
+    async def _close_socket(self, code):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def shutdown(self, code, timeout=2.0):
+        # 積んである分を送り切ってから閉じる（timeout 秒で送り切れなければ打ち切る）
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.append((_CLOSE, code))
+        self._ready.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._writer), timeout)
+        except Exception:
+            self._abort(code)
+
+    def close(self):
+        self.closed = True
+        self._queue.clear()
+        self._writer.cancel()
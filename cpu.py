@@ -0,0 +1,305 @@
+# CPU 対戦相手の着手選択
+#
+# 強さ（level）は "random" / "greedy" / "alphabeta:<深さ>" の文字列で表す。
+# alphabeta は反復深化 + Zobrist ハッシュの置換表（LRU で件数上限あり）で探索し、
+# 1 手ごとの持ち時間を超えたら直前に読み切った深さの最善手を返す。
+# alphabeta では定石（book.OpeningBook）を先に引き、空きマスが
+# endgame_empties 以下なら終盤は石差を完全に読み切る。
+
+import random
+import time
+from collections import OrderedDict
+
+import engine
+
+LEVELS = ("random", "greedy", "alphabeta")
+DEFAULT_LEVEL = "random"
+DEFAULT_DEPTH = 4
+MAX_DEPTH = 12
+ENDGAME_EMPTIES = 8
+
+# 盤面の位置ごとの重み（角を重視し、角の隣を嫌う）
+WEIGHTS = (
+    100, -20, 10,  5,  5, 10, -20, 100,
+    -20, -50, -2, -2, -2, -2, -50, -20,
+     10,  -2,  1,  1,  1,  1,  -2,  10,
+      5,  -2,  1,  0,  0,  1,  -2,   5,
+      5,  -2,  1,  0,  0,  1,  -2,   5,
+     10,  -2,  1,  1,  1,  1,  -2,  10,
+    -20, -50, -2, -2, -2, -2, -50, -20,
+    100, -20, 10,  5,  5, 10, -20, 100,
+)
+# 重みごとのマスのビット集合（評価関数で popcount するため）
+WEIGHT_MASKS = tuple(
+    (w, sum(1 << sq for sq in range(64) if WEIGHTS[sq] == w))
+    for w in sorted(set(WEIGHTS)) if w
+)
+MOBILITY_WEIGHT = 5
+WIN_SCORE = 10000
+
+EXACT, LOWER, UPPER = 0, 1, 2
+INF = float("inf")
+
+_rng = random.Random(0x0BE110)
+ZOBRIST = {
+    engine.BLACK: tuple(_rng.getrandbits(64) for _ in range(64)),
+    engine.WHITE: tuple(_rng.getrandbits(64) for _ in range(64)),
+}
+# 石の色が反転したときの差分（黒と白のキーの XOR）
+ZOBRIST_FLIP = tuple(b ^ w for b, w in zip(ZOBRIST[engine.BLACK], ZOBRIST[engine.WHITE]))
+ZOBRIST_SIDE = _rng.getrandbits(64)
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class TranspositionTable:
+    # 件数上限つきの置換表。上限を超えたら最も古く参照されたものから捨てる
+    def __init__(self, max_entries=200_000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+def parse_level(mode):
+    # register の mode から強さを取り出して正規化する。
+    # "cpu" / "cpu:greedy" / "cpu:alphabeta:6" または
+    # {"type": "cpu", "level": "alphabeta", "depth": 6}
+    if isinstance(mode, dict):
+        kind = mode.get("level") or DEFAULT_LEVEL
+        depth = mode.get("depth")
+    else:
+        parts = str(mode).split(":")[1:]
+        kind = parts[0] if parts else DEFAULT_LEVEL
+        depth = parts[1] if len(parts) > 1 else None
+
+    if kind not in LEVELS:
+        kind = DEFAULT_LEVEL
+    if kind != "alphabeta":
+        return kind
+    try:
+        depth = int(depth) if depth is not None else DEFAULT_DEPTH
+    except (TypeError, ValueError):
+        depth = DEFAULT_DEPTH
+    return f"alphabeta:{max(1, min(depth, MAX_DEPTH))}"
+
+
+def is_cpu_mode(mode):
+    if isinstance(mode, dict):
+        return mode.get("type") == "cpu"
+    return str(mode).split(":")[0] == "cpu"
+
+
+def zobrist(black, white, color):
+    h = 0
+    for sq in engine.iter_squares(black):
+        h ^= ZOBRIST[engine.BLACK][sq]
+    for sq in engine.iter_squares(white):
+        h ^= ZOBRIST[engine.WHITE][sq]
+    if color == engine.WHITE:
+        h ^= ZOBRIST_SIDE
+    return h
+
+
+def evaluate(player, opponent):
+    # 手番側から見た評価値（位置の重み + 着手可能数の差）
+    score = 0
+    for w, mask in WEIGHT_MASKS:
+        score += w * ((player & mask).bit_count() - (opponent & mask).bit_count())
+    mobility = (engine.legal_moves(player, opponent).bit_count()
+                - engine.legal_moves(opponent, player).bit_count())
+    return score + MOBILITY_WEIGHT * mobility
+
+
+def final_score(player, opponent):
+    diff = player.bit_count() - opponent.bit_count()
+    if diff > 0:
+        return WIN_SCORE + diff
+    if diff < 0:
+        return -WIN_SCORE + diff
+    return 0
+
+
+def order_moves(moves, first=None):
+    # 置換表の最善手を先頭に、あとは位置の重みが大きい順
+    ordered = sorted(engine.iter_squares(moves), key=WEIGHTS.__getitem__, reverse=True)
+    if first is not None and moves & (1 << first):
+        ordered.remove(first)
+        ordered.insert(0, first)
+    return ordered
+
+
+class AlphaBeta:
+    def __init__(self, table, deadline):
+        self.table = table
+        self.deadline = deadline
+        self.nodes = 0
+
+    def search(self, position, color, max_depth):
+        h = zobrist(*position.to_colors(color), color)
+        best = order_moves(position.moves())[0]
+        for depth in range(1, max_depth + 1):
+            try:
+                _, move = self.negamax(position, h, color, depth, -INF, INF)
+            except SearchTimeout:
+                break
+            if move is not None:
+                best = move
+        return best
+
+    def negamax(self, position, h, color, depth, alpha, beta):
+        self.nodes += 1
+        if self.nodes & 255 == 0 and time.monotonic() > self.deadline:
+            raise SearchTimeout()
+
+        alpha_orig = alpha
+        tt_move = None
+        entry = self.table.get(h)
+        if entry is not None:
+            e_depth, e_value, e_flag, tt_move = entry
+            if e_depth >= depth:
+                if e_flag == EXACT:
+                    return e_value, tt_move
+                if e_flag == LOWER:
+                    alpha = max(alpha, e_value)
+                else:
+                    beta = min(beta, e_value)
+                if alpha >= beta:
+                    return e_value, tt_move
+
+        moves = position.moves()
+        if not moves:
+            passed = position.pass_turn()
+            if not passed.moves():
+                return final_score(position.player, position.opponent), None
+            value, _ = self.negamax(passed, h ^ ZOBRIST_SIDE, -color, depth, -beta, -alpha)
+            return -value, None
+        if depth == 0:
+            return evaluate(position.player, position.opponent), None
+
+        best, best_move = -INF, None
+        for sq in order_moves(moves, tt_move):
+            child = position.play(sq)
+            child_h = h ^ ZOBRIST_SIDE ^ ZOBRIST[color][sq]
+            for f in engine.iter_squares(child.opponent & ~position.player & ~(1 << sq)):
+                child_h ^= ZOBRIST_FLIP[f]
+            value = -self.negamax(child, child_h, -color, depth - 1, -beta, -alpha)[0]
+            if value > best:
+                best, best_move = value, sq
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                break
+
+        if best <= alpha_orig:
+            flag = UPPER
+        elif best >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.table.put(h, (depth, best, flag, best_move))
+        return best, best_move
+
+
+class Endgame:
+    # 終盤の完全読み（評価値は最終的な石差）
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.nodes = 0
+
+    def solve(self, position):
+        best, best_move = -INF, None
+        alpha = -64
+        for sq in order_moves(position.moves()):
+            value = -self.negamax(position.play(sq), -64, -alpha)
+            if value > best:
+                best, best_move = value, sq
+                alpha = max(alpha, value)
+        return best, best_move
+
+    def negamax(self, position, alpha, beta):
+        self.nodes += 1
+        if self.nodes & 1023 == 0 and time.monotonic() > self.deadline:
+            raise SearchTimeout()
+
+        moves = position.moves()
+        if not moves:
+            passed = position.pass_turn()
+            if not passed.moves():
+                return position.player.bit_count() - position.opponent.bit_count()
+            return -self.negamax(passed, -beta, -alpha)
+
+        best = -64
+        for sq in order_moves(moves):
+            value = -self.negamax(position.play(sq), -beta, -alpha)
+            if value > best:
+                best = value
+                if value > alpha:
+                    alpha = value
+                    if alpha >= beta:
+                        break
+        return best
+
+
+def choose_move(black, white, color, legal, level=DEFAULT_LEVEL, time_budget=1.0, table=None,
+                book=None, endgame_empties=ENDGAME_EMPTIES):
+    # color 側の着手（マス番号）を選ぶ。legal は color 側の合法手
+    moves = list(engine.iter_squares(legal))
+    if len(moves) == 1:
+        return moves[0]
+
+    kind, _, depth = level.partition(":")
+    if kind == "greedy":
+        player, opponent = engine.split(black, white, color)
+        return max(moves, key=lambda sq: (engine.flips(player, opponent, sq).bit_count(), WEIGHTS[sq]))
+    if kind == "alphabeta":
+        position = engine.Position.from_colors(black, white, color)
+        if book is not None:
+            sq = book.lookup(position.player, position.opponent)
+            if sq is not None and legal & (1 << sq):
+                return sq
+
+        start = time.monotonic()
+        if position.empties() <= endgame_empties:
+            # 読み切りには持ち時間の半分まで使い、間に合わなければ通常の探索へ
+            try:
+                return Endgame(start + time_budget / 2).solve(position)[1]
+            except SearchTimeout:
+                pass
+
+        search = AlphaBeta(table if table is not None else TranspositionTable(),
+                           start + time_budget)
+        return search.search(position, color, int(depth or DEFAULT_DEPTH))
+    return random.choice(moves)
+
+
+# プロセスプール（cpu_pool）のワーカー側。置換表はワーカープロセスごとに持つ
+_worker_table = None
+
+
+def init_worker(tt_size):
+    global _worker_table
+    _worker_table = TranspositionTable(tt_size)
+
+
+def worker_choose_move(black, white, color, legal, level, time_budget, endgame_empties=ENDGAME_EMPTIES):
+    # 定石はプールに渡す前に親プロセスで引くので、ここでは引かない
+    return choose_move(black, white, color, legal, level, time_budget, _worker_table,
+                       endgame_empties=endgame_empties)
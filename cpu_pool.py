@@ -0,0 +1,79 @@
+# CPU の探索をプロセスプールで実行し、イベントループを止めないようにする
+#
+# 同時に受け付ける探索数に上限を設け、上限に達している間は空きを
+# 持ち時間ぶんだけ待ち、それでも空かなければその場で greedy に落とす。
+# 定石はプールに渡す前にこのプロセスで引く（mmap の二分探索なので軽い）。
+
+import asyncio
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cpu
+import engine
+import metrics
+
+
+class CpuPool:
+    def __init__(self, workers, max_pending, tt_size, book=None, endgame_empties=cpu.ENDGAME_EMPTIES):
+        self.workers = workers
+        self.tt_size = tt_size
+        self.book = book
+        self.endgame_empties = endgame_empties
+        self.max_pending = max_pending
+        self.pending = 0
+        self._slots = asyncio.Semaphore(max_pending)
+        self._executor = None
+
+    def _get_executor(self):
+        # 起動時ではなく最初の探索でワーカーを立ち上げる
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=cpu.init_worker,
+                initargs=(self.tt_size,),
+            )
+        return self._executor
+
+    async def choose_move(self, black, white, color, legal, level, time_budget):
+        # 着手と、どこで決めたか（inline / book / fallback / search）ごとの所要時間を記録する
+        start = time.perf_counter()
+        sq, source = await self._choose_move(black, white, color, legal, level, time_budget)
+        metrics.CPU_SEARCH.labels(source).observe(time.perf_counter() - start)
+        return sq
+
+    async def _choose_move(self, black, white, color, legal, level, time_budget):
+        # random / greedy と合法手が 1 つの場合は軽いのでその場で計算する
+        if not level.startswith("alphabeta") or legal & (legal - 1) == 0:
+            return cpu.choose_move(black, white, color, legal, level), "inline"
+
+        if self.book is not None:
+            sq = self.book.lookup(*engine.split(black, white, color))
+            if sq is not None and legal & (1 << sq):
+                return sq, "book"
+
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=time_budget)
+        except asyncio.TimeoutError:
+            logging.warning(f"[CPU] 探索待ちが上限（{self.max_pending}）に達したため greedy で応答")
+            return cpu.choose_move(black, white, color, legal, "greedy"), "fallback"
+
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            # キャンセルされた場合、未開始の探索はプールから取り除かれる
+            # （実行中の探索も持ち時間で必ず終わる）
+            sq = await loop.run_in_executor(
+                self._get_executor(), cpu.worker_choose_move,
+                black, white, color, legal, level, time_budget, self.endgame_empties)
+            return sq, "search"
+        finally:
+            self.pending -= 1
+            self._slots.release()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,185 @@
+# オセロのビットボードエンジン
+#
+# 盤面は黒石・白石それぞれ 64bit の整数で表す。
+# マス (x, y) は bit x * 8 + y に対応する（board[x][y] と同じ並び）。
+
+BLACK = 1
+WHITE = -1
+
+FULL = 0xFFFFFFFFFFFFFFFF
+NOT_LEFT = 0xFEFEFEFEFEFEFEFE    # y == 0 の列を除く
+NOT_RIGHT = 0x7F7F7F7F7F7F7F7F   # y == 7 の列を除く
+
+# (ビットシフト量, シフト後に掛けるマスク)
+# 正は左シフト、負は右シフト。横方向への移動は列の折り返しをマスクで落とす。
+DIRECTIONS = (
+    (1, NOT_LEFT),     # ( 0, +1)
+    (-1, NOT_RIGHT),   # ( 0, -1)
+    (8, FULL),         # (+1,  0)
+    (-8, FULL),        # (-1,  0)
+    (9, NOT_LEFT),     # (+1, +1)
+    (7, NOT_RIGHT),    # (+1, -1)
+    (-7, NOT_LEFT),    # (-1, +1)
+    (-9, NOT_RIGHT),   # (-1, -1)
+)
+
+INITIAL_BLACK = (1 << 28) | (1 << 35)   # (3, 4), (4, 3)
+INITIAL_WHITE = (1 << 27) | (1 << 36)   # (3, 3), (4, 4)
+
+
+def shift(bits, d, mask):
+    if d > 0:
+        return (bits << d) & mask & FULL
+    return (bits >> -d) & mask
+
+
+def square(x, y):
+    return x * 8 + y
+
+
+def coords(sq):
+    return divmod(sq, 8)
+
+
+def iter_squares(bits):
+    # 立っているビットのマス番号を小さい順に返す
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+def count(bits):
+    return bits.bit_count()
+
+
+def initial():
+    return INITIAL_BLACK, INITIAL_WHITE
+
+
+def legal_moves(player, opponent):
+    # 手番側 player が打てるマスのビット集合
+    empty = ~(player | opponent) & FULL
+    moves = 0
+    for d, mask in DIRECTIONS:
+        t = shift(player, d, mask) & opponent
+        t |= shift(t, d, mask) & opponent
+        t |= shift(t, d, mask) & opponent
+        t |= shift(t, d, mask) & opponent
+        t |= shift(t, d, mask) & opponent
+        t |= shift(t, d, mask) & opponent
+        moves |= shift(t, d, mask) & empty
+    return moves
+
+
+def flips(player, opponent, sq):
+    # sq に置いたときに裏返る石のビット集合（置けない場合は 0）
+    bit = 1 << sq
+    if (player | opponent) & bit:
+        return 0
+    flipped = 0
+    for d, mask in DIRECTIONS:
+        line = 0
+        m = shift(bit, d, mask)
+        while m & opponent:
+            line |= m
+            m = shift(m, d, mask)
+        if m & player:
+            flipped |= line
+    return flipped
+
+
+def is_legal(player, opponent, sq):
+    return flips(player, opponent, sq) != 0
+
+
+def play(player, opponent, sq):
+    # 着手後の (player, opponent) を返す。非合法手なら ValueError
+    flipped = flips(player, opponent, sq)
+    if not flipped:
+        raise ValueError(f"illegal move: {coords(sq)}")
+    return player | flipped | (1 << sq), opponent & ~flipped
+
+
+def split(black, white, color):
+    # color 側から見た (player, opponent)
+    return (black, white) if color == BLACK else (white, black)
+
+
+def join(player, opponent, color):
+    # split の逆変換
+    return (player, opponent) if color == BLACK else (opponent, player)
+
+
+def from_list(board):
+    # 8x8 のリスト（1: 黒, -1: 白, 0: 空）からビットボードへ
+    black = white = 0
+    for x, row in enumerate(board):
+        for y, v in enumerate(row):
+            if v == BLACK:
+                black |= 1 << (x * 8 + y)
+            elif v == WHITE:
+                white |= 1 << (x * 8 + y)
+    return black, white
+
+
+def to_list(black, white):
+    # クライアント向けの 8x8 リスト形式へ
+    board = [[0] * 8 for _ in range(8)]
+    for sq in iter_squares(black):
+        board[sq >> 3][sq & 7] = BLACK
+    for sq in iter_squares(white):
+        board[sq >> 3][sq & 7] = WHITE
+    return board
+
+
+def advance(black, white, color):
+    # color が着手した後の (次の手番, その合法手)。
+    # 相手に合法手がなければ自動パスで color のまま、両者なければ終局で 0
+    nxt = -color
+    moves = legal_moves(*split(black, white, nxt))
+    if moves:
+        return nxt, moves
+    moves = legal_moves(*split(black, white, color))
+    if moves:
+        return color, moves
+    return 0, 0
+
+
+class Position:
+    # 手番側から見た局面（探索・定石作成で手番の入れ替えを持ち回らないためのもの）
+    __slots__ = ("player", "opponent")
+
+    def __init__(self, player, opponent):
+        self.player = player
+        self.opponent = opponent
+
+    @classmethod
+    def from_colors(cls, black, white, color):
+        return cls(*split(black, white, color))
+
+    def to_colors(self, color):
+        return join(self.player, self.opponent, color)
+
+    def moves(self):
+        return legal_moves(self.player, self.opponent)
+
+    def empties(self):
+        return 64 - (self.player | self.opponent).bit_count()
+
+    def play(self, sq):
+        # 着手後の局面（手番は相手に移る）。非合法手なら ValueError
+        player, opponent = play(self.player, self.opponent, sq)
+        return Position(opponent, player)
+
+    def pass_turn(self):
+        return Position(self.opponent, self.player)
+
+
+def pack(black, white):
+    # 16 バイトの固定長表現（黒 8 バイト + 白 8 バイト、ビッグエンディアン）
+    return black.to_bytes(8, "big") + white.to_bytes(8, "big")
+
+
+def unpack(data):
+    return int.from_bytes(data[:8], "big"), int.from_bytes(data[8:16], "big")
@@ -0,0 +1,76 @@
+# クライアントから届くメッセージの型
+#
+# 種類（type）ごとの pydantic モデルを判別共用体にまとめ、TypeAdapter を起動時に
+# 1 度だけ作っておく。受信した文字列は validate_json で JSON の解析と検証を
+# 一度に行い、形の合わないメッセージはハンドラに届く前に ValidationError にする。
+
+from typing import Annotated, Literal, Optional, Union
+
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, ValidationError
+
+UserId = Annotated[str, Field(min_length=1, max_length=64)]
+BoardFormat = Literal["list", "packed"]
+# "online" / "cpu" / "cpu:greedy" / "cpu:alphabeta:6"（それ以外の文字列は受け付けない）
+ModeName = Annotated[str, Field(pattern=r"^(online|cpu(:(random|greedy|alphabeta)(:[0-9]{1,2})?)?)$")]
+
+
+class _Message(BaseModel):
+    # 未知のフィールドは無視する（古い・新しいクライアントが余分に送ってきても通す）
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
+
+class CpuMode(_Message):
+    # {"type": "cpu", "level": "alphabeta", "depth": 6}（深さは cpu.parse_level で丸める）
+    type: Literal["cpu"]
+    level: Optional[Literal["random", "greedy", "alphabeta"]] = None
+    depth: Optional[Annotated[int, Field(ge=1, le=99)]] = None
+
+
+class Register(_Message):
+    type: Literal["register"]
+    user_id: UserId
+    name: str = Field("", max_length=32)
+    mode: Union[ModeName, CpuMode] = "online"
+    board_format: Optional[BoardFormat] = None
+    # 再接続時、クライアントが知っている手数
+    ply: Optional[Annotated[int, Field(ge=0)]] = None
+
+
+class Watch(_Message):
+    type: Literal["watch"]
+    game_id: Annotated[str, Field(min_length=1, max_length=64)]
+    board_format: Optional[BoardFormat] = None
+
+
+class Move(_Message):
+    type: Literal["move"]
+    x: Annotated[int, Field(ge=0, le=7)]
+    y: Annotated[int, Field(ge=0, le=7)]
+
+
+class Pass(_Message):
+    type: Literal["pass"]
+
+
+class Surrender(_Message):
+    type: Literal["surrender"]
+    # 旧クライアントが送ってくるが、降参するのは常にその接続のユーザー
+    user_id: Optional[str] = None
+
+
+class EndGame(_Message):
+    type: Literal["end_game"]
+
+
+_INITIAL = TypeAdapter(Annotated[Union[Register, Watch], Field(discriminator="type")])
+_IN_GAME = TypeAdapter(Annotated[Union[Move, Pass, Surrender, EndGame], Field(discriminator="type")])
+
+
+def parse_initial(text):
+    # 接続直後の 1 通目（register / watch）
+    return _INITIAL.validate_json(text)
+
+
+def parse_message(text):
+    # register 後のメッセージ（move / pass / surrender / end_game）
+    return _IN_GAME.validate_json(text)
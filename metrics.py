@@ -0,0 +1,190 @@
+# サーバー内の計測値（Prometheus のテキスト形式で出力できる）
+#
+# label を指定したものは labels(値) ごとに別々に集計する（値の種類は固定の少数に限ること）
+
+import bisect
+import time
+from contextlib import contextmanager
+
+REGISTRY = []
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._children = {}
+        if label is None:
+            self.labels(None)
+        REGISTRY.append(self)
+
+    def labels(self, value):
+        child = self._children.get(value)
+        if child is None:
+            child = self._children[value] = self._new()
+        return child
+
+    def label_values(self):
+        # これまでに labels(値) で使った値
+        return [value for value in self._children if value is not None]
+
+    def _new(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for value, child in sorted(self._children.items(), key=lambda item: str(item[0])):
+            label = "" if value is None else f'{self.label}="{value}"'
+            lines.extend(child.samples(self.name, label))
+        return lines
+
+
+def _sample(name, label, value, extra=""):
+    labels = ",".join(l for l in (label, extra) if l)
+    return f"{name}{{{labels}}} {value}" if labels else f"{name} {value}"
+
+
+class _CounterValue:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, label):
+        return [_sample(name, label, self.value)]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self.labels(None).inc(amount)
+
+
+class _GaugeValue:
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        # 出力のたびに function() の値を読む
+        self.function = function
+
+    def samples(self, name, label):
+        value = self.function() if self.function is not None else self.value
+        return [_sample(name, label, value)]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new(self):
+        return _GaugeValue()
+
+    def set(self, value):
+        self.labels(None).set(value)
+
+    def set_function(self, function):
+        self.labels(None).set_function(function)
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        # with ブロックの所要時間（秒）を記録する
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self, name, label):
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            lines.append(_sample(f"{name}_bucket", label, cumulative, f'le="{bound}"'))
+        lines.append(_sample(f"{name}_bucket", label, self.count, 'le="+Inf"'))
+        lines.append(_sample(f"{name}_sum", label, self.sum))
+        lines.append(_sample(f"{name}_count", label, self.count))
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets, label=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, label)
+
+    def _new(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels(None).observe(value)
+
+    def time(self):
+        return self.labels(None).time()
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+MATCHES = Counter("othello_matches_total", "Number of online matches made")
+MATCH_WAIT = Histogram(
+    "othello_match_wait_seconds", "Time a player waited in the queue before being matched",
+    (1, 2, 5, 10, 20, 30, 60, 120, 300),
+)
+MATCH_RATING_DIFF = Histogram(
+    "othello_match_rating_diff", "Absolute rating difference between matched players",
+    (25, 50, 100, 200, 400, 800),
+)
+ACTIVE_SOCKETS = Gauge("othello_active_sockets", "WebSocket connections registered on this worker")
+SPECTATORS = Gauge("othello_spectators", "Spectators watching games on this worker")
+REJECTED = Counter(
+    "othello_rejected_total", "Connections and messages refused by admission control", "reason",
+)
+QUEUE_DEPTH = Gauge("othello_waiting_players", "Players waiting in the matchmaking queue", "mode")
+MESSAGE_LATENCY = Histogram(
+    "othello_message_seconds", "Time spent handling one client message", LATENCY_BUCKETS, "type",
+)
+REDIS_LATENCY = Histogram(
+    "othello_redis_seconds", "Redis round-trip time per operation", LATENCY_BUCKETS, "op",
+)
+CPU_SEARCH = Histogram(
+    "othello_cpu_move_seconds", "Time taken to choose a CPU move", LATENCY_BUCKETS, "source",
+)
+LOOP_LAG = Histogram(
+    "othello_event_loop_lag_seconds", "How late the event loop woke up a periodic timer",
+    LATENCY_BUCKETS,
+)
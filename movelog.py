@@ -0,0 +1,59 @@
+# 対局の棋譜（着手ログ）
+#
+# 先頭 1 文字が先手（"b" / "w"）、以降は 1 手を 1 文字（マス番号 + 48、"0".."o"）で
+# 表し、Redis の文字列に APPEND していく。旧クライアントからの明示的なパスは "." で
+# 記録する。盤面はときどきスナップショットとして保存し、復元はスナップショット
+# 以降の手だけを再生する。
+
+import engine
+
+PASS = "."
+_OFFSET = 48
+HEADER = 1
+
+
+def header(color):
+    return "b" if color == engine.BLACK else "w"
+
+
+def parse(record):
+    # 棋譜全体を (先手, 着手の並び) に分ける
+    return (engine.WHITE if record[:HEADER] == "w" else engine.BLACK), record[HEADER:]
+
+
+def encode(sq):
+    return PASS if sq is None else chr(_OFFSET + sq)
+
+
+def decode(entry):
+    # マス番号（パスは None）
+    return None if entry == PASS else ord(entry) - _OFFSET
+
+
+def step(black, white, color, entry):
+    # color の手番で entry を適用した後の (black, white, 次の手番, その合法手)。
+    # 終局なら手番は着手側の相手（パスなら自分）のまま、合法手は 0
+    sq = decode(entry)
+    if sq is not None:
+        player, opponent = engine.play(*engine.split(black, white, color), sq)
+        black, white = engine.join(player, opponent, color)
+    next_color, legal = engine.advance(black, white, color)
+    if not next_color:
+        next_color = color if sq is None else -color
+    return black, white, next_color, legal
+
+
+def replay(log, black=None, white=None, color=engine.BLACK, ply=None):
+    # (black, white, color) の局面から log の先頭 ply 手（省略時は全部）を再生し、
+    # (black, white, 手番, 合法手) を返す
+    if black is None:
+        black, white = engine.initial()
+    legal = engine.legal_moves(*engine.split(black, white, color))
+    for entry in log[:ply]:
+        black, white, color, legal = step(black, white, color, entry)
+    return black, white, color, legal
+
+
+def moves(log):
+    # クライアント向けの [[x, y], ...]（パスは None）
+    return [None if decode(e) is None else list(engine.coords(decode(e))) for e in log]
@@ -0,0 +1,47 @@
+# サンプリングプロファイラ（PROFILE_INTERVAL を指定したときだけ動かす）
+#
+# 別スレッドから一定間隔でメインスレッドのスタックを覗き、関数の並びごとに
+# 回数を数える。出力は flamegraph.pl / speedscope で読める collapsed 形式。
+
+import sys
+import threading
+from collections import Counter
+
+
+class Sampler:
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = Counter()
+        self._target = threading.main_thread().ident
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="sampler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def collapsed(self, reset=False):
+        lines = [f"{stack} {n}" for stack, n in self.samples.most_common()]
+        if reset:
+            self.samples.clear()
+        return "\n".join(lines) + "\n"
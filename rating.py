@@ -0,0 +1,15 @@
+# Elo レーティング
+
+DEFAULT_RATING = 1500.0
+K_FACTOR = 32.0
+
+
+def expected(rating, opponent_rating):
+    return 1.0 / (1.0 + 10 ** ((opponent_rating - rating) / 400.0))
+
+
+def update(winner_rating, loser_rating, draw=False, k=K_FACTOR):
+    # 対局後の (勝者, 敗者) のレーティング。引き分けなら両者 0.5 として計算
+    score = 0.5 if draw else 1.0
+    delta = k * (score - expected(winner_rating, loser_rating))
+    return winner_rating + delta, loser_rating - delta
@@ -0,0 +1,195 @@
+# ワーカー間のメッセージ配送
+#
+# 各ワーカーは自分が WebSocket を持っているユーザーを Redis の routes ハッシュ
+# （user_id -> worker_id）に登録する。送信先がこのワーカーにいればそのまま送り、
+# 別ワーカーにいればそのワーカー専用のチャンネル worker:{worker_id} に publish する。
+# 観戦用のチャンネル（watch(...) で購読したもの）に届いたメッセージは on_broadcast に渡す。
+# 各ワーカーは alive:{worker_id} を heartbeat_ttl 秒の期限付きで書き直し続け、期限の切れた
+# （落ちた）ワーカーを指す経路は、ないものとして扱う。
+
+import asyncio
+import json
+import logging
+import uuid
+
+ROUTES_KEY = "routes"
+ALIVE_PREFIX = "alive:"
+
+# ARGV のユーザーごとに、生きているワーカーへの経路（なければ ""）
+_LIVE_ROUTES = """
+local result = {}
+for i, user_id in ipairs(ARGV) do
+    local worker_id = redis.call('HGET', KEYS[1], user_id)
+    if worker_id and redis.call('EXISTS', KEYS[2] .. worker_id) == 1 then
+        result[i] = worker_id
+    else
+        result[i] = ''
+    end
+end
+return result
+"""
+
+# 経路がない、または落ちたワーカーを指しているときだけ ARGV[2] に向ける。向けたら 1
+_CLAIM = """
+local worker_id = redis.call('HGET', KEYS[1], ARGV[1])
+if worker_id and redis.call('EXISTS', KEYS[2] .. worker_id) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return 1
+"""
+
+
+class Router:
+    def __init__(self, rdb, deliver, on_broadcast=None, worker_id=None, heartbeat_ttl=15):
+        # deliver(user_id, frame, board) はこのワーカーの接続に送る関数。
+        # 送れたら True、接続がなければ False を返す。
+        # worker_id を固定すると、再起動後も同じチャンネルで受け取れる
+        self.rdb = rdb
+        self.deliver = deliver
+        self.on_broadcast = on_broadcast
+        self.worker_id = worker_id or uuid.uuid4().hex
+        self.channel = f"worker:{self.worker_id}"
+        self.heartbeat_ttl = heartbeat_ttl
+        self._live_routes = rdb.register_script(_LIVE_ROUTES)
+        self._claim = rdb.register_script(_CLAIM)
+        self._pubsub = None
+        self._watching = set()
+        # 自分のエントリのときだけ消す（別ワーカーへの再接続を上書きしない）
+        self._unregister = rdb.register_script("""
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return 0
+""")
+
+    async def register(self, user_id):
+        # 登録前の worker_id（なければ None）を返す
+        async with self.rdb.pipeline(transaction=True) as pipe:
+            pipe.hget(ROUTES_KEY, user_id)
+            pipe.hset(ROUTES_KEY, user_id, self.worker_id)
+            previous, _ = await pipe.execute()
+        return previous
+
+    async def unregister(self, user_id):
+        await self._unregister(keys=[ROUTES_KEY], args=[user_id, self.worker_id])
+
+    async def claim_many(self, user_ids):
+        # 経路がない（か落ちたワーカーを指している）ユーザーだけ自分に向け、向けられたユーザーを返す
+        # （すでに別ワーカーに再接続しているユーザーの経路は奪わない）
+        if not user_ids:
+            return []
+        async with self.rdb.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                await self._claim(keys=[ROUTES_KEY, ALIVE_PREFIX], args=[user_id, self.worker_id],
+                                  client=pipe)
+            claimed = await pipe.execute()
+        return [user_id for user_id, ok in zip(user_ids, claimed) if ok]
+
+    async def owned(self, user_ids):
+        # 経路がこのワーカーを指しているユーザー
+        if not user_ids:
+            return []
+        workers = await self.rdb.hmget(ROUTES_KEY, user_ids)
+        return [uid for uid, w in zip(user_ids, workers) if w == self.worker_id]
+
+    async def unregister_many(self, user_ids, pipe=None):
+        # pipe を渡すとそのパイプラインに積むだけで実行はしない
+        if pipe is not None:
+            for user_id in user_ids:
+                await self._unregister(keys=[ROUTES_KEY], args=[user_id, self.worker_id], client=pipe)
+            return
+        if user_ids:
+            async with self.rdb.pipeline(transaction=False) as pipe:
+                await self.unregister_many(user_ids, pipe)
+                await pipe.execute()
+
+    async def heartbeat(self):
+        # 生きている印を heartbeat_ttl 秒の期限付きで書き直し続ける
+        while True:
+            try:
+                await self.beat()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"[WARN] ワーカーの生存通知に失敗: {e}")
+            await asyncio.sleep(self.heartbeat_ttl / 3)
+
+    async def beat(self):
+        await self.rdb.set(ALIVE_PREFIX + self.worker_id, 1, ex=self.heartbeat_ttl)
+
+    async def _routes(self, user_ids):
+        # 生きているワーカーへの経路（なければ ""）
+        return await self._live_routes(keys=[ROUTES_KEY, ALIVE_PREFIX], args=list(user_ids))
+
+    async def is_online(self, user_id, local=()):
+        if user_id in local:
+            return True
+        return bool((await self._routes([user_id]))[0])
+
+    async def online(self, user_ids, local=()):
+        # 複数ユーザーの is_online を 1 往復で
+        if not user_ids:
+            return []
+        workers = await self._routes(user_ids)
+        return [uid in local or bool(w) for uid, w in zip(user_ids, workers)]
+
+    async def send(self, user_id, frame, board=None):
+        # frame は dict。board=(black, white) は受信側で相手の形式に変換する
+        if not user_id or user_id == "cpu":
+            return False
+        if await self.deliver(user_id, frame, board):
+            return True
+        worker_id = (await self._routes([user_id]))[0]
+        if not worker_id or worker_id == self.worker_id:
+            return False
+        await self.rdb.publish(f"worker:{worker_id}", json.dumps({
+            "to": user_id,
+            "frame": frame,
+            "board": list(board) if board is not None else None,
+        }))
+        return True
+
+    async def watch(self, channel):
+        # 観戦用のチャンネルを購読する（再接続時も購読し直す）
+        if channel not in self._watching:
+            self._watching.add(channel)
+            if self._pubsub is not None:
+                await self._pubsub.subscribe(channel)
+
+    async def unwatch(self, channel):
+        if channel in self._watching:
+            self._watching.discard(channel)
+            if self._pubsub is not None:
+                await self._pubsub.unsubscribe(channel)
+
+    async def _forward(self, data):
+        data = json.loads(data)
+        board = tuple(data["board"]) if data.get("board") else None
+        if not await self.deliver(data["to"], data["frame"], board):
+            logging.info(f"[ROUTE] {data['to']} はこのワーカーに接続していません")
+
+    async def listen(self):
+        # 他ワーカーから届いたメッセージをこのワーカーの接続に配送する
+        while True:
+            pubsub = self._pubsub = self.rdb.pubsub()
+            try:
+                await pubsub.subscribe(self.channel, *self._watching)
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    try:
+                        if message["channel"] == self.channel:
+                            await self._forward(message["data"])
+                        elif self.on_broadcast is not None:
+                            self.on_broadcast(message["channel"], message["data"])
+                    except Exception as e:
+                        logging.warning(f"[WARN] 転送メッセージの送信に失敗: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"[WARN] pub/sub の購読が切れました（再接続します）: {e}")
+                await asyncio.sleep(1)
+            finally:
+                self._pubsub = None
+                await pubsub.aclose()
@@ -1,12 +1,34 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Header, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse, Response
 import uuid
 import json
+import base64
 import random
 import logging
 import asyncio
+import time
 import redis.asyncio as redis
 import os
+import secrets
+import signal
+import threading
 from dotenv import load_dotenv
+import engine
+import cpu
+import book
+import metrics
+import rating
+import movelog
+import profiler
+import analysis
+import messages
+from sessions import GameSession, SessionStore
+from cpu_pool import CpuPool
+from routing import Router
+from connection import Connection
+from timers import TimerScheduler
+from spectators import Spectators
+from admission import Admission
 
 load_dotenv()  # .env を読み込む
 
@@ -15,19 +37,253 @@ rdb = redis.from_url(redis_url, decode_responses=True)
 
 logging.basicConfig(level=logging.INFO)
 
-app = FastAPI()
+# CPU の 1 手あたりの持ち時間（秒）と置換表の件数上限（ワーカープロセスごと）
+CPU_TIME_BUDGET = float(os.getenv("CPU_TIME_BUDGET", "1.0"))
+CPU_TT_SIZE = int(os.getenv("CPU_TT_SIZE", "200000"))
+# 探索用プロセス数と、同時に受け付ける探索数の上限
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", str(min(4, os.cpu_count() or 1))))
+CPU_MAX_PENDING = int(os.getenv("CPU_MAX_PENDING", "32"))
+# 定石ファイル（book.py build で作成）と、終盤を読み切り始める空きマス数
+OPENING_BOOK = os.getenv("OPENING_BOOK", "book.bin")
+ENDGAME_EMPTIES = int(os.getenv("ENDGAME_EMPTIES", str(cpu.ENDGAME_EMPTIES)))
+cpu_pool = CpuPool(CPU_WORKERS, CPU_MAX_PENDING, CPU_TT_SIZE,
+                   book.load(OPENING_BOOK), ENDGAME_EMPTIES)
+
+# 一括解析（POST /analysis）用のプロセス数（0 なら全コア）と、1 回に受け付ける局面数の上限
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "0"))
+ANALYSIS_MAX_POSITIONS = int(os.getenv("ANALYSIS_MAX_POSITIONS", "20000"))
+# 1 回の探索時間の合計（局面数 × time_budget 秒）の上限と、同時に処理する解析リクエスト数（超えたら 429）
+ANALYSIS_MAX_SEARCH_SECONDS = float(os.getenv("ANALYSIS_MAX_SEARCH_SECONDS", "300"))
+ANALYSIS_MAX_CONCURRENT = int(os.getenv("ANALYSIS_MAX_CONCURRENT", "1"))
+# /analysis に必要な Bearer トークン。未設定なら /analysis は使えない
+ANALYSIS_TOKEN = os.getenv("ANALYSIS_TOKEN", "")
+analyzer = analysis.Analyzer(ANALYSIS_WORKERS or None, CPU_TT_SIZE)
+analysis_slots = asyncio.Semaphore(ANALYSIS_MAX_CONCURRENT)
+
+# マッチングをまとめて行う間隔（秒）と、1 回に成立させる最大組数
+MATCH_WINDOW = float(os.getenv("MATCH_WINDOW", "2.0"))
+MATCH_BATCH_SIZE = int(os.getenv("MATCH_BATCH_SIZE", "100"))
+# 相手を探すレーティング幅の初期値・待ち 1 秒ごとの広がり・上限
+MATCH_RATING_WINDOW = float(os.getenv("MATCH_RATING_WINDOW", "100"))
+MATCH_WINDOW_WIDEN = float(os.getenv("MATCH_WINDOW_WIDEN", "10"))
+MATCH_MAX_RATING_WINDOW = float(os.getenv("MATCH_MAX_RATING_WINDOW", "800"))
+# キャッシュ中の対局を Redis にまとめて書き出す間隔（秒）
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "0.5"))
+# 接続ごとの未送信フレームの上限（超えたら接続を閉じる）
+OUTBOX_SIZE = int(os.getenv("OUTBOX_SIZE", "256"))
+# 盤面のスナップショットを保存する間隔（手数）と、終局後の棋譜の保存期間（秒）
+SNAPSHOT_EVERY = int(os.getenv("SNAPSHOT_EVERY", "8"))
+RECORD_TTL = int(os.getenv("RECORD_TTL", str(7 * 24 * 3600)))
+# 切断・降参から対局を片付けるまでの猶予（秒）
+DISCONNECT_GRACE = int(os.getenv("DISCONNECT_GRACE", "40"))
+# 観戦者の上限（対局ごと・ワーカーごと）と観戦者の未送信フレームの上限、
+# 他ワーカーの観戦者へフレームをまとめて転送する間隔（秒）
+SPECTATOR_LIMIT = int(os.getenv("SPECTATOR_LIMIT", "5000"))
+SPECTATOR_OUTBOX = int(os.getenv("SPECTATOR_OUTBOX", "64"))
+BROADCAST_INTERVAL = float(os.getenv("BROADCAST_INTERVAL", "0.1"))
+# 同時接続数の上限（超えたら server_busy を返して閉じる）と、1 メッセージの最大文字数
+# （uvicorn の --ws-max-size でフレーム自体の上限も絞っておくこと）
+MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", "10000"))
+MAX_MESSAGE_SIZE = int(os.getenv("MAX_MESSAGE_SIZE", "4096"))
+# 接続ごと・送信元 IP ごとのメッセージ数のレート（1 秒あたり）とバースト、
+# 続けて何回制限にかかったら接続を閉じるか
+MESSAGE_RATE = float(os.getenv("MESSAGE_RATE", "10"))
+MESSAGE_BURST = int(os.getenv("MESSAGE_BURST", "20"))
+IP_MESSAGE_RATE = float(os.getenv("IP_MESSAGE_RATE", "50"))
+IP_MESSAGE_BURST = int(os.getenv("IP_MESSAGE_BURST", "100"))
+RATE_LIMIT_STRIKES = int(os.getenv("RATE_LIMIT_STRIKES", "20"))
+admission = Admission(MAX_CONNECTIONS, MESSAGE_RATE, MESSAGE_BURST, IP_MESSAGE_RATE, IP_MESSAGE_BURST)
+# ワーカー名（Pod 名など、再起動しても変わらない名前）。指定すると終了時に接続中のユーザーと
+# 切断の猶予タイマーを引き継ぎ情報として残し、同じ名前で起動したワーカーが読み込む
+WORKER_NAME = os.getenv("WORKER_NAME", "")
+# ワーカーの生存通知の有効期限（秒）。これより長く通知のないワーカーへの経路はオフライン扱い
+WORKER_HEARTBEAT_TTL = int(os.getenv("WORKER_HEARTBEAT_TTL", "15"))
+# 終了時にクライアントへ送る再接続までの待ち時間の上限（秒。クライアントごとにばらつかせる）と、
+# 引き継ぎ情報・終了時に接続していたユーザーのデータの有効期限（秒）
+RECONNECT_SPREAD = float(os.getenv("RECONNECT_SPREAD", "5"))
+HANDOFF_TTL = int(os.getenv("HANDOFF_TTL", "600"))
+# /admin/drain に必要な Bearer トークン。未設定なら /admin/drain は使えない
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# サンプリングプロファイラの間隔（秒）。0 なら動かさない（/debug/profile で結果を取得）
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0"))
 
+app = FastAPI()
+background_tasks = []
+sampler = profiler.Sampler(PROFILE_INTERVAL) if PROFILE_INTERVAL > 0 else None
+
+@app.on_event("startup")
+async def start_matchmaker():
+    background_tasks.append(asyncio.create_task(matchmaker()))
+    background_tasks.append(asyncio.create_task(session_flusher()))
+    background_tasks.append(asyncio.create_task(router.listen()))
+    background_tasks.append(asyncio.create_task(router.heartbeat()))
+    background_tasks.append(asyncio.create_task(grace_timers.run()))
+    background_tasks.append(asyncio.create_task(loop_lag_monitor()))
+    background_tasks.append(asyncio.create_task(broadcast_flusher()))
+    if sampler is not None:
+        sampler.start()
+    install_sigterm_drain()
+    try:
+        await restore_handoff()
+    except Exception as e:
+        logging.warning(f"[HANDOFF] 引き継ぎ情報の読み込みに失敗: {e}")
 
+@app.on_event("shutdown")
+async def shutdown_background():
+    # 接続は SIGTERM ハンドラ（install_sigterm_drain）か /admin/drain で引き継ぎ済み。
+    # ここに来る時点で uvicorn が接続を閉じ終えているので、残っている対局の書き出しだけになる
+    try:
+        await drain()
+    except Exception as e:
+        logging.warning(f"[DRAIN] 終了処理に失敗: {e}")
+    for task in background_tasks:
+        task.cancel()
+    cpu_pool.shutdown()
+    analyzer.shutdown()
+    if sampler is not None:
+        sampler.stop()
+
+def check_token(expected, authorization):
+    # Authorization: Bearer <token> を定数時間で比べる
+    if not secrets.compare_digest((authorization or "").encode(), f"Bearer {expected}".encode()):
+        raise HTTPException(status_code=401, detail="unauthorized")
+
+@app.post("/admin/drain")
+async def drain_endpoint(authorization: str | None = Header(None)):
+    # SIGTERM でも drain するので、呼ぶのは SIGTERM より前にロードバランサーから外したいとき（preStop など）
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="admin endpoints are disabled (set ADMIN_TOKEN)")
+    check_token(ADMIN_TOKEN, authorization)
+    return {"draining": True, "connections": await drain()}
+
+@app.get("/healthz")
+async def health_endpoint():
+    # drain 後は 503 を返し、ロードバランサーの振り分け先から外してもらう
+    if draining:
+        raise HTTPException(status_code=503, detail="draining")
+    return {"status": "ok"}
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    # 待機キューの長さは Redis から読んでから出力する
+    modes = list(await rdb.smembers("queue:modes"))
+    async with rdb.pipeline(transaction=False) as pipe:
+        for mode in modes:
+            pipe.zcard(queue_key(mode))
+        for mode, depth in zip(modes, await pipe.execute()):
+            metrics.QUEUE_DEPTH.labels(mode).set(depth)
+    # 待機者がいなくなったモードは queue:modes から消えるので、前回の値を残さず 0 にする
+    for mode in metrics.QUEUE_DEPTH.label_values():
+        if mode not in modes:
+            metrics.QUEUE_DEPTH.labels(mode).set(0)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/debug/profile")
+async def profile_endpoint(reset: bool = False):
+    if sampler is None:
+        raise HTTPException(status_code=404, detail="profiler is disabled (set PROFILE_INTERVAL)")
+    return PlainTextResponse(sampler.collapsed(reset))
+
+async def loop_lag_monitor(interval=0.5):
+    # 一定間隔の sleep がどれだけ遅れて戻るか（イベントループの詰まり具合）
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        metrics.LOOP_LAG.observe(max(0.0, loop.time() - start - interval))
+
+
+# user_id -> Connection（送信キュー付きの WebSocket）
 connected_sockets = {}
-
-def save_board():
-    board = [[0] * 8 for _ in range(8)]
-    mid = 4
-    board[mid - 1][mid - 1] = -1
-    board[mid][mid] = -1
-    board[mid - 1][mid] = 1
-    board[mid][mid - 1] = 1
-    return board
+# user_id -> クライアントが register で指定した盤面の形式（"list" / "packed"）
+board_formats = {}
+# game_id -> GameSession（このワーカーで進行中の対局）
+sessions = SessionStore()
+# user_id -> 実行中の CPU 手番タスク（切断・降参時にキャンセル）
+cpu_tasks = {}
+# このワーカーの全接続（対局者・観戦者・register 前のもの）。drain で閉じる
+open_connections = set()
+# drain 後は新しい接続・マッチング・着手を受け付けない
+draining = False
+# user_id -> 起動時に引き継ぎ情報から読み込んだ load_player の結果（register で 1 度だけ使う）
+preloaded = {}
+# game_id -> 観戦者のグループ（このワーカーに接続している観戦者）
+spectators = Spectators(SPECTATOR_LIMIT)
+# game_id -> 観戦者のいるワーカー数（broadcast_flusher が Redis の watchers から読み直す）
+watched_games = {}
+# 他ワーカーの観戦者向けに次の broadcast_flusher で publish するフレーム
+broadcast_buffer = []
+# game_id -> 観戦者に盤面を送り直すタスク（resync_spectators）
+resync_tasks = {}
+metrics.ACTIVE_SOCKETS.set_function(lambda: len(connected_sockets))
+metrics.SPECTATORS.set_function(lambda: len(spectators))
+
+def color_value(color):
+    return engine.BLACK if color == "black" else engine.WHITE
+
+def game_over(black, white):
+    # どちらにも合法手がない（終局）
+    return engine.advance(black, white, engine.BLACK)[0] == 0
+
+def color_name(value):
+    # 終局（0）は None
+    return {engine.BLACK: "black", engine.WHITE: "white"}.get(value)
+
+def encode_board(black, white):
+    # Redis 保存用・"packed" クライアント向けの 16 バイト盤面（base64 で 24 文字）
+    return base64.b64encode(engine.pack(black, white)).decode("ascii")
+
+def decode_board(value):
+    # 旧形式（8x8 リストの JSON）もそのまま読めるようにする
+    if value.startswith("["):
+        return engine.from_list(json.loads(value))
+    return engine.unpack(base64.b64decode(value))
+
+def board_payload(user_id, black, white):
+    # 受信者が register で選んだ形式で盤面を返す（既定は従来の 8x8 リスト）
+    if board_formats.get(user_id) == "packed":
+        return encode_board(black, white)
+    return engine.to_list(black, white)
+
+def moves_list(legal):
+    # 合法手のビット集合をクライアント向けの [[x, y], ...] に変換
+    return [list(engine.coords(sq)) for sq in engine.iter_squares(legal)]
+
+async def deliver(user_id, frame, board=None):
+    # このワーカーに接続しているユーザーに送る。board=(black, white) は受信者の形式で入れる
+    # 送信キューに積むだけなので、遅い相手がいても待たない
+    conn = connected_sockets.get(user_id)
+    if conn is None:
+        # 読み込み済みの対局が別のワーカーで進んだので、再接続時は Redis から読み直す
+        preloaded.pop(user_id, None)
+        return False
+    if board is not None:
+        frame = dict(frame, board=board_payload(user_id, *board))
+    return conn.send(frame)
+
+def receive_broadcast(channel, data):
+    # 他ワーカーで処理した対局の観戦者向けフレーム（"送信元ワーカー 手数 フレーム"）。
+    # 手数が "=<手数>" のものは盤面全体で、フレームは [black, white, 手番]
+    origin, ply, text = data.split(" ", 2)
+    if origin == router.worker_id:
+        return
+    game_id = channel.removeprefix("watch:")
+    if ply.startswith("="):
+        black, white, turn = json.loads(text)
+        publish_snapshot(game_id, black, white, turn, int(ply[1:]))
+    elif spectators.publish(game_id, None if ply == "-" else int(ply), text):
+        resync_spectators(game_id)
+
+# 別ワーカーに接続しているユーザーへは Redis pub/sub で転送する
+router = Router(rdb, deliver, receive_broadcast, WORKER_NAME or None, WORKER_HEARTBEAT_TTL)
+
+async def fan_out(sends):
+    # 複数人への送信を並行して行い、1 人の失敗で他を止めない
+    results = await asyncio.gather(*sends, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logging.warning(f"[WARN] 送信に失敗: {result}")
+    return results
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
@@ -35,328 +291,309 @@ async def websocket_endpoint(websocket: WebSocket):
             # 再接続時に盤面・ターンを復元送信
     
     await websocket.accept()
+    if draining:
+        await websocket.send_text(json.dumps(reconnect_notice()))
+        await websocket.close(code=1012)
+        return
+    limits, reason = admission.admit(websocket.client.host if websocket.client else "")
+    if limits is None:
+        # 断る理由をクライアントに伝えてから閉じる（1013: 時間をおいて再試行）
+        metrics.REJECTED.labels(reason).inc()
+        logging.warning(f"[ADMISSION] 接続を拒否しました（{reason}）")
+        await websocket.send_text(json.dumps({
+            "type": "error",
+            "reason": "server_busy" if reason == "capacity" else "rate_limited"
+        }))
+        await websocket.close(code=1013)
+        return
+    conn = Connection(websocket, OUTBOX_SIZE)
+    open_connections.add(conn)
     user_id=None
 
     try:
-        init_message = await websocket.receive_text()
-        logging.info(f"[DEBUG] 初期メッセージ受信: {init_message}")
-        init_data = json.loads(init_message)
-        logging.info(f"[DEBUG] 初期データ: {init_data}")
-        data_type = init_data.get("type")
-
-        if data_type == "register":
-            user_id = init_data.get("user_id")
-            name = init_data.get("name")
-            mode = init_data.get("mode", "online")
-            connected_sockets[user_id] = websocket
+        init_message = await receive_message(websocket, conn, limits)
+        if init_message is None:
+            # レート制限で捨てた（rate_limited は receive_message が送っている）。1013: 時間をおいて再試行
+            await conn.shutdown(1013)
+            return
+        started = time.perf_counter()
+        # 接続ごとに出るので、DEBUG 以外では文字列を組み立てない
+        logging.debug("[DEBUG] 初期メッセージ受信: %s", init_message)
+        try:
+            init_data = messages.parse_initial(init_message)
+        except messages.ValidationError:
+            metrics.REJECTED.labels("invalid").inc()
+            conn.send({"type": "error", "reason": "invalid_message"})
+            await conn.shutdown(1008)
+            return
+
+        if init_data.type == "watch":
+            await watch_game(websocket, conn, limits, init_data)
+            return
+
+        if init_data.type == "register":
+            user_id = init_data.user_id
+            name = init_data.name
+            mode = init_data.mode
+            if isinstance(mode, messages.CpuMode):
+                mode = mode.model_dump()
+            cpu_level = None
+            if cpu.is_cpu_mode(mode):
+                # "cpu:alphabeta:6" や {"type": "cpu", "level": ...} から強さを取り出す
+                cpu_level = cpu.parse_level(mode)
+                mode = "cpu"
+            connected_sockets[user_id] = conn
+            previous = await router.register(user_id)
+            # 猶予時間内の再接続なら片付けのタイマーを取り消す
+            if grace_timers.cancel(user_id):
+                logging.info(f"[REGISTER] {user_id} が猶予時間内に再接続しました")
+            if init_data.board_format == "packed":
+                board_formats[user_id] = "packed"
+            else:
+                board_formats.pop(user_id, None)
 
             logging.info(f"[REGISTER] user_id={user_id}, name={name} が接続しました")
 
-            exists = await rdb.exists(f"user:{user_id}")
-            if exists:
-                status = await rdb.hget(f"user:{user_id}", "status")
+            # 先読みは経路が自分を指したままだったときだけ使う（別のワーカーで続けた対局なら読み直す）
+            player = preloaded.pop(user_id, None)
+            if player is None or previous != router.worker_id:
+                player = await load_player(user_id)
+            status = player["status"]
+            if status is not None:
                 logging.info(f"[REGISTER] Redisに既存 user:{user_id}（status={status}）")
                 if status == "matched":
 
-                    game_id = await rdb.hget(f"user:{user_id}", "game_id")
-
-                    board_data = await rdb.get(f"board:{game_id}")
-                    turn = await rdb.get(f"turn:{game_id}")
-                    color = await rdb.hget(f"user:{user_id}", "color")
-                    opponent_id = await rdb.hget(f"user:{user_id}", "opponent")
-                    your_turn = (turn == color)
+                    game_id = player["game_id"]
+                    color = player["color"]
+                    opponent_id = player["opponent"]
 
-                    opponent_name = await rdb.hget(f"user:{opponent_id}", "name") if opponent_id else None
+                    opponent_name = player["opponent_name"]
 
-                    if board_data and turn and color:
-                        logging.info(f"[RESTORE] user_id={user_id}, turn={turn}, color={color}")
-                        await websocket.send_text(json.dumps({
-                            "type": "restore_board",
-                            "board": json.loads(board_data),
+                    if player["board"] and player["turn"] and color:
+                        black, white, turn, legal = decode_position(player)
+                        ply = position_ply(player)
+                        logging.info(f"[RESTORE] user_id={user_id}, turn={turn}, color={color}, ply={ply}")
+                        restore = {
                             "current_player": turn,
                             "your_color": 1 if color == "black" else -1,
-                            "your_turn": your_turn,
+                            "your_turn": (turn == color),
                             "opponent_name": opponent_name,
+                            "legal_moves": moves_list(legal),
+                            "ply": ply,
                             "reconnect_code": True
-                        }))
-                        logging.info(f"[RESTORE] Sent restore_board to {user_id}")
-
-                    # 相手に通知
-                        if opponent_id in connected_sockets:
-                            try:
-                                await connected_sockets[opponent_id].send_text(json.dumps({
-                                    "type": "opponent_reconnected",
-                                    "user_id": user_id
-                                }))
+                        }
+                        # 切断・drain で付けた有効期限を外す（対局を続けるのでデータは残す）
+                        async with rdb.pipeline(transaction=False) as pipe:
+                            pipe.persist(f"user:{user_id}")
+                            if opponent_id != "cpu":
+                                pipe.persist(f"user:{opponent_id}")
+                            pipe.expire(game_key(game_id), GAME_TTL)
+                            await pipe.execute()
+                        # クライアントが何手目まで知っているか送ってきたら、足りない手だけ送る
+                        seen = init_data.ply
+                        if seen is not None and seen <= ply:
+                            missed = await load_moves(game_id, player, seen)
+                            conn.send({
+                                "type": "restore_moves",
+                                "from_ply": seen,
+                                "moves": movelog.moves(missed),
+                                **restore
+                            })
+                            logging.info(f"[RESTORE] Sent {len(missed)} moves to {user_id}")
+                        else:
+                            conn.send({
+                                "type": "restore_board",
+                                "board": board_payload(user_id, black, white),
+                                **restore
+                            })
+                            logging.info(f"[RESTORE] Sent restore_board to {user_id}")
+
+                    # CPU の手番で切断していた場合は CPU の応答を再開
+                        if opponent_id == "cpu" and turn != color:
+                            players = [(user_id, color), (opponent_id, turn)]
+                            start_cpu_turn(user_id, game_id, players, black, white, turn, legal, player["cpu_level"])
+
+                    # 相手に通知（別ワーカーに接続していても届く）
+                        try:
+                            if await router.send(opponent_id, {
+                                "type": "opponent_reconnected",
+                                "user_id": user_id
+                            }):
                                 logging.info(f"[RESTORE] Notified opponent {opponent_id}")
-                            
+
                             # 最新盤面を相手にも送る
-                                opponent_turn = await rdb.get(f"turn:{game_id}")
-                                opponent_board_data = await rdb.get(f"board:{game_id}")
-                               
-
-                                if opponent_turn and opponent_board_data:
-                                   
-                                    await connected_sockets[opponent_id].send_text(json.dumps({
-                                        "type": "update_board",
-                                        "board": json.loads(opponent_board_data),
-                                        
-                                    }))
-                            except Exception as e:
-                                logging.info(f"[WARN] Failed to notify opponent: {e}")
+                                await router.send(opponent_id, {
+                                    "type": "update_board",
+                                }, board=(black, white))
+                        except Exception as e:
+                            logging.info(f"[WARN] Failed to notify opponent: {e}")
                     else:
                         logging.info(f"[RESTORE] board_data などが不完全")
 
                 else:
                 # 🆕 初回接続と判定 → Redis に登録
                     logging.info(f"[REGISTER] user_id={user_id} はstatus={status}のため、マッチング待機に復帰")
-                    await rdb.hset(f"user:{user_id}", mapping={
-                        "name": name,
-                        "status": "waiting",
-                        "opponent": "",
-                        "mode": mode
-                    })
-                    asyncio.create_task(try_match(user_id))
+                    await register_waiting(user_id, name, mode)
+                    await enqueue_waiting(user_id, mode)
             else:
                 
                 # 🆕 初回接続と判定 → Redis に登録
                 logging.info(f"[REGISTER] user_id={user_id} は新規登録と判断")
-                await rdb.hset(f"user:{user_id}", mapping={
-                    "name": name,
-                    "status": "waiting",
-                    "opponent": "",
-                    "mode": mode
-                })
-                
+                await register_waiting(user_id, name, mode)
 
                 if mode == "cpu":
-                    await start_cpu_game(websocket, user_id, name)
+                    await start_cpu_game(user_id, name, cpu_level)
                 else:
-                    asyncio.create_task(try_match(user_id))
+                    await enqueue_waiting(user_id, mode)
+            metrics.MESSAGE_LATENCY.labels("register").observe(time.perf_counter() - started)
 
-   
         
         
         while True:
          try:
-            message = await websocket.receive_text()
-            data = json.loads(message)
-
-
-            if data.get("type") == "move":
-                x = data["x"]
-                y = data["y"]
-
-                opponent_id = await rdb.hget(f"user:{user_id}", "opponent")
-                my_color = await rdb.hget(f"user:{user_id}", "color")
-                opponent_color = "black" if my_color == "white" else "white"
-
-    # 現在の board を取得し、反転処理
-                game_id = await rdb.hget(f"user:{user_id}", "game_id")
-                board_data = await rdb.get(f"board:{game_id}")
-                board = json.loads(board_data) if board_data else [[0]*8 for _ in range(8)]
-                color_value = 1 if my_color == "black" else -1
-
-    # 石を置いて、反転処理を実行
-                def place_stone(board, x, y, color):
-                    directions = [(-1, -1), (-1, 0), (-1, 1),
-                                  (0, -1),          (0, 1),
-                                  (1, -1),  (1, 0), (1, 1)]
-                    flipped = []
-
-                    if board[x][y] != 0:
-                        return board  # 無効な位置
-
-                    board[x][y] = color
-                    for dx, dy in directions:
-                        nx, ny = x + dx, y + dy
-                        temp = []
-                        while 0 <= nx < 8 and 0 <= ny < 8 and board[nx][ny] == -color:
-                            temp.append((nx, ny))
-                            nx += dx
-                            ny += dy
-                        if 0 <= nx < 8 and 0 <= ny < 8 and board[nx][ny] == color:
-                            for fx, fy in temp:
-                                board[fx][fy] = color
-                                flipped.append((fx, fy))
-                    return board
-
-                board = place_stone(board, x, y, color_value)
-
-    # 次のターンを決定
-                current_turn = await rdb.get(f"turn:{game_id}")
-                if not current_turn:
-                    current_turn = "black"
-                next_turn = "white" if current_turn == "black" else "black"
-
-    # Redisに保存（再接続対応）
-                await rdb.set(f"board:{game_id}", json.dumps(board), ex=3600)
-                
-                await rdb.set(f"turn:{game_id}", next_turn, ex=3600)
-               
-
-    # 両者に座標と色、次のターンを通知（board は送らない）
-                for uid, color, socket in [
-                    (user_id, my_color, connected_sockets.get(user_id)),
-                    (opponent_id, opponent_color, connected_sockets.get(opponent_id))
-                ]:
-                    if socket:
-                        await socket.send_text(json.dumps({
-                            "type": "move",
+            message = await receive_message(websocket, conn, limits)
+            if message is None:
+                continue
+            try:
+                data = messages.parse_message(message)
+            except messages.ValidationError:
+                metrics.REJECTED.labels("invalid").inc()
+                conn.send({"type": "error", "reason": "invalid_message"})
+                continue
+            if draining:
+                # 状態は書き出し済みなので、再接続先のワーカーで打ち直してもらう
+                conn.send({"type": "error", "reason": "server_draining"})
+                continue
+            with metrics.MESSAGE_LATENCY.labels(data.type).time():
+                if data.type == "move":
+                    x = data.x
+                    y = data.y
+
+        # 対局の状態（このワーカーのキャッシュ、なければ Redis から 1 往復で取得）
+                    session = await get_session(user_id)
+                    if session is None:
+                        continue
+                    opponent_id = session.opponent_of(user_id)
+                    my_color = session.color_of(user_id)
+                    opponent_color = "black" if my_color == "white" else "white"
+
+        # 現在の局面と、キャッシュ済みの合法手
+                    game_id = session.game_id
+                    black, white, turn, legal = session.black, session.white, session.turn, session.legal
+
+        # 手番・合法手チェック（不正な手は盤面を変えずにエラーを返す）
+                    if turn != my_color:
+                        conn.send({
+                            "type": "error",
+                            "reason": "not_your_turn",
                             "x": x,
-                            "y": y,
-                            "color": my_color,
-                            "next_turn": next_turn,
-                            "your_color": "black" if my_color == 1 else "white",
-                            "your_turn": (next_turn == color)
-                        }))
-                                        # 追加：相手がCPUなら即応答
-                if opponent_id == "cpu":
-                    
-
-                    def valid_moves(board, color):
-                        moves = []
-                        for i in range(8):
-                            for j in range(8):
-                                temp_board = [row[:] for row in board]
-                                result = place_stone(temp_board, i, j, color)
-                                if result != board:
-                                    moves.append((i, j))
-                        return moves
-                    
-                    cpu_value = 1 if opponent_color == "black" else -1
-                    cpu_moves = valid_moves(board, cpu_value)
-
-                    if cpu_moves:
-                        cx, cy = random.choice(cpu_moves)
-                        board = place_stone(board, cx, cy, cpu_value)
-
-                        # ターンを元に戻す（再びプレイヤー）
-                        next_turn = my_color
-
-                        # 通知（player = user_id）
-                        if connected_sockets.get(user_id):
-                            await connected_sockets[user_id].send_text(json.dumps({
-                                "type": "move",
-                                "x": cx,
-                                "y": cy,
-                                "color": opponent_color,
-                                "next_turn": next_turn,
-                                "your_color": my_color,
-                                "your_turn": True
-                            }))
-
-            elif data.get("type") == "pass":
-                game_id = await rdb.hget(f"user:{user_id}", "game_id")
-                opponent_id = await rdb.hget(f"user:{user_id}", "opponent")
-
-    # 現在の board を取得
-                board_data = await rdb.get(f"board:{game_id}")
-                board = json.loads(board_data) if board_data else [[0]*8 for _ in range(8)]
-
-    # パス回数記録
-                my_passed = await rdb.get(f"pass:{user_id}")
-                opponent_passed = await rdb.get(f"pass:{opponent_id}")
-
-                if my_passed == "true" and opponent_passed == "true":
-                    print("[INFO] 両者が連続でパスしました。ゲーム終了処理を開始します。")
-                    for uid in [user_id, opponent_id]:
-                        if uid in connected_sockets:
-                            await connected_sockets[uid].send_text(json.dumps({
-                                "type": "end_game",
-                                "board": board,
-                                "your_color": await rdb.hget(f"user:{uid}", "color")
-                            }))
-                    return
-                await rdb.set(f"pass:{user_id}", "true", ex=40)
-
-                current_turn = await rdb.get(f"turn:{game_id}")
-                if not current_turn:
-                    current_turn = "black"
-                next_turn = "white" if current_turn == "black" else "black"
-
-    # 保存（再接続用）
-                await rdb.set(f"board:{game_id}", json.dumps(board), ex=3600)
-                
-                await rdb.set(f"turn:{game_id}", next_turn, ex=3600)
-                
-    # 相手にパス通知
-                opponent_color = await rdb.hget(f"user:{opponent_id}", "color")
-                if opponent_id in connected_sockets:
-                    await connected_sockets[opponent_id].send_text(json.dumps({
+                            "y": y
+                        })
+                        continue
+                    if not legal & (1 << engine.square(x, y)):
+                        conn.send({
+                            "type": "error",
+                            "reason": "illegal_move",
+                            "x": x,
+                            "y": y
+                        })
+                        continue
+
+                    players = [(user_id, my_color), (opponent_id, opponent_color)]
+                    black, white, next_turn, legal = await play_move(
+                        game_id, players, black, white, my_color, engine.square(x, y))
+
+        # 追加：相手がCPUなら応答（探索はプロセスプールで行い、受信ループは止めない）
+                    if opponent_id == "cpu" and next_turn == opponent_color:
+                        start_cpu_turn(user_id, game_id, players, black, white, opponent_color, legal, session.cpu_level)
+                    elif next_turn is None:
+                        await finish_game(user_id)
+
+                elif data.type == "pass":
+                    session = await get_session(user_id)
+                    if session is None:
+                        continue
+                    game_id = session.game_id
+                    my_color = session.color_of(user_id)
+                    black, white, turn, legal = session.black, session.white, session.turn, session.legal
+
+        # パスはサーバー側で自動的に行うので、クライアントからのパスは確認のみ
+                    if turn != my_color:
+                        logging.info(f"[PASS] {user_id} のパスはサーバー側で処理済み")
+                        continue
+                    if legal:
+                        conn.send({
+                            "type": "error",
+                            "reason": "illegal_pass"
+                        })
+                        continue
+
+        # 自動パス導入前に保存された局面向け：手番を相手に渡す
+                    opponent_id = session.opponent_of(user_id)
+                    opponent_color = "black" if my_color == "white" else "white"
+                    value, legal = engine.advance(black, white, color_value(my_color))
+                    next_turn = color_name(value)
+                    ply = await save_position(game_id, black, white, next_turn or my_color, legal,
+                                              movelog.PASS)
+
+        # 相手にパス通知
+                    await router.send(opponent_id, {
                         "type": "pass",
+                        "color": my_color,
                         "next_turn": next_turn,
                         "your_color": opponent_color,
-                        "your_turn": (next_turn == opponent_color)
-            }))
+                        "your_turn": (next_turn == opponent_color),
+                        "legal_moves": moves_list(legal),
+                        "ply": ply
+                    })
+                    broadcast(game_id, ply, {"type": "pass", "color": my_color,
+                                             "next_turn": next_turn, "ply": ply})
+
+                    if opponent_id == "cpu" and next_turn == opponent_color:
+                        players = [(user_id, my_color), (opponent_id, opponent_color)]
+                        start_cpu_turn(user_id, game_id, players, black, white, opponent_color, legal, session.cpu_level)
+                    elif next_turn is None:
+                        await finish_game(user_id)
                     
-            elif data["type"] == "surrender":
-                surrender_id = data["user_id"]
-                opponent_id = await rdb.hget(f"user:{surrender_id}", "opponent")
-                game_id = await rdb.hget(f"user:{surrender_id}", "game_id")
-
-                logging.info(f"[SURRENDER] {surrender_id} が降参")
-
-    # 相手に通知
-                if opponent_id and opponent_id in connected_sockets:
-                    await connected_sockets[opponent_id].send_text(json.dumps({
+                elif data.type == "surrender":
+                    # 降参できるのはこの接続のユーザーだけ
+                    surrender_id = user_id
+                    await release_session(surrender_id)
+                    opponent_id, game_id = await rdb.hmget(f"user:{surrender_id}", "opponent", "game_id")
+
+                    logging.info(f"[SURRENDER] {surrender_id} が降参")
+                    cancel_cpu_turn(surrender_id)
+                    await update_ratings(game_id, opponent_id, surrender_id)
+                    broadcast(game_id, None, {"type": "end_game", "reason": "surrender"})
+
+        # 相手に通知
+                    if opponent_id and await router.send(opponent_id, {
                         "type": "opponent_surrendered"
-                    }))
+                    }):
     
-    # Redisの削除
+        # Redisの削除
                 
-                # Redisに expire を設定（すぐ削除せず、後で wait_end が処理）
-                    await rdb.expire(f"board:{game_id}", 1)
-                    await rdb.expire(f"turn:{game_id}", 1)
-
-                    await rdb.expire(f"user:{surrender_id}", 1)
-                    await rdb.expire(f"user:{opponent_id}", 1)
-
-# 接続解除
-                    connected_sockets.pop(surrender_id, None)
-                    connected_sockets.pop(opponent_id, None)
-
-# 終了処理をスケジュール（disconnectと統一）
-                    asyncio.create_task(wait_end(surrender_id, opponent_id))
+                    # Redisに expire を設定（すぐ削除せず、後で grace_timers が処理）
+                        async with rdb.pipeline(transaction=False) as pipe:
+                            pipe.expire(game_key(game_id), 1)
+                            pipe.expire(moves_key(game_id), RECORD_TTL)
+                            pipe.expire(f"user:{surrender_id}", 1)
+                            pipe.expire(f"user:{opponent_id}", 1)
+                            await pipe.execute()
+
+    # 接続解除
+                        connected_sockets.pop(surrender_id, None)
+                        connected_sockets.pop(opponent_id, None)
+                        board_formats.pop(surrender_id, None)
+                        board_formats.pop(opponent_id, None)
+                        await router.unregister(surrender_id)
+
+    # 終了処理をスケジュール（disconnectと統一）
+                        grace_timers.schedule(surrender_id, DISCONNECT_GRACE, (surrender_id, opponent_id))
        
                     
-            elif data.get("type") == "end_game":
-                opponent_id = await rdb.hget(f"user:{user_id}", "opponent")
-                game_id = await rdb.hget(f"user:{user_id}", "game_id")
-
-    # 再接続用に有効期限を延長
-                await rdb.expire(f"board:{game_id}", 40)
-                
-                await rdb.expire(f"turn:{game_id}", 40)
-                
-    # Redisから取得（受信ではなく）
-                board_data = await rdb.get(f"board:{game_id}")
-                turn = await rdb.get(f"turn:{game_id}")
-                board = json.loads(board_data) if board_data else [[0]*8 for _ in range(8)]
-
-                my_color = await rdb.hget(f"user:{user_id}", "color")
-                opponent_color = "black" if my_color == "white" else "white"
-
-    # 状態を waiting に戻す
-                await rdb.hset(f"user:{user_id}", mapping={"status": "waiting", "opponent": ""})
-                await rdb.hset(f"user:{opponent_id}", mapping={"status": "waiting", "opponent": ""})
-
-                for uid, color, socket in [
-                     (user_id, my_color, connected_sockets.get(user_id)),
-                     (opponent_id, opponent_color, connected_sockets.get(opponent_id))
-                ]:
-                    if socket:
-                        try:
-                            opponent_name = await rdb.hget(f"user:{opponent_id if uid == user_id else user_id}", "name")
-                            await socket.send_text(json.dumps({
-                                "type": "end_game",
-                                "board": board,
-                                "current_player": 1 if turn == "black" else -1,
-                                "your_color": color,
-                                "opponent_name":opponent_name
-                            }))
-                        except Exception as e:
-                            logging.warning(f"[WARN] end_game 送信失敗: {e}")
+                elif data.type == "end_game":
+                    await finish_game(user_id)
 
                 
          except WebSocketDisconnect:
@@ -366,190 +603,980 @@ async def websocket_endpoint(websocket: WebSocket):
             break
     except Exception as e:
         logging.warning(f"[WARN] 通常ループ中のエラー: {e}")
-
-async def try_match(current_id):
-    logging.info(f"[DEBUG] try_match called for {current_id}")
-    
-    
-    all_keys = await rdb.keys("user:*")
-    waiting_users = []
-    for key in all_keys:
-        uid = key.split(":")[1]
-        status = await rdb.hget(key, "status")
-        if status == "waiting":
-            waiting_users.append(uid)
-
-    logging.info(f"[DEBUG] waiting_users =", waiting_users)
-
-    if len(waiting_users) < 2:
+    finally:
+        if user_id and connected_sockets.get(user_id) is conn:
+            # handle_disconnect まで進まずに抜けたときも経路と接続を残さない
+            connected_sockets.pop(user_id, None)
+            board_formats.pop(user_id, None)
+            try:
+                await router.unregister(user_id)
+            except Exception as e:
+                logging.warning(f"[WARN] {user_id} の経路を削除できませんでした: {e}")
+        conn.close()
+        open_connections.discard(conn)
+        admission.release()
+
+async def register_waiting(user_id, name, mode):
+    # 切断・drain で付けた有効期限も外す（残っていると待機中・対局中にデータが消える）
+    async with rdb.pipeline(transaction=True) as pipe:
+        pipe.hset(f"user:{user_id}", mapping={
+            "name": name,
+            "status": "waiting",
+            "opponent": "",
+            "mode": mode
+        })
+        pipe.persist(f"user:{user_id}")
+        await pipe.execute()
+
+async def receive_message(websocket, conn, limits):
+    # 大きすぎるメッセージは読んだ時点で接続を閉じ、レート制限を超えたものは捨てて None を返す。
+    # 制限に RATE_LIMIT_STRIKES 回続けてかかった接続は閉じる（どちらも切断として扱う）
+    message = await websocket.receive_text()
+    if len(message) > MAX_MESSAGE_SIZE:
+        metrics.REJECTED.labels("message_size").inc()
+        logging.warning(f"[ADMISSION] {len(message)} 文字のメッセージを受信したため接続を閉じます")
+        await websocket.close(code=1009)
+        raise WebSocketDisconnect(code=1009)
+    if limits.allow():
+        return message
+    metrics.REJECTED.labels("rate_limited").inc()
+    if limits.strikes >= RATE_LIMIT_STRIKES:
+        logging.warning("[ADMISSION] レート制限を超え続けたため接続を閉じます")
+        await websocket.close(code=1008)
+        raise WebSocketDisconnect(code=1008)
+    if limits.strikes == 1:
+        conn.send({"type": "error", "reason": "rate_limited"})
+    return None
+
+GAME_TTL = 3600
+
+def game_key(game_id):
+    # 対局のスナップショット（board / turn / legal / ply）は 1 つのハッシュにまとめる
+    return f"game:{game_id}"
+
+def moves_key(game_id):
+    # 対局の棋譜（movelog 形式。1 手 1 文字で追記する）
+    return f"moves:{game_id}"
+
+PLAYER_FIELDS = ("status", "name", "game_id", "color", "opponent", "opponent_name", "cpu_level",
+                 "board", "turn", "legal", "ply", "log")
+
+# user ハッシュと、その対局のスナップショット・それ以降の棋譜を 1 往復で読む
+LOAD_PLAYER_SCRIPT = rdb.register_script("""
+local user = redis.call('HMGET', KEYS[1], 'status', 'name', 'game_id', 'color',
+                        'opponent', 'opponent_name', 'cpu_level')
+local game = {false, false, false, false}
+local log = false
+if user[3] then
+    game = redis.call('HMGET', 'game:' .. user[3], 'board', 'turn', 'legal', 'ply')
+    log = redis.call('GETRANGE', 'moves:' .. user[3], (tonumber(game[4]) or 0) + 1, -1)
+end
+return {user[1], user[2], user[3], user[4], user[5], user[6], user[7],
+        game[1], game[2], game[3], game[4], log}
+""")
+
+async def load_player(user_id):
+    with metrics.REDIS_LATENCY.labels("load_player").time():
+        values = await LOAD_PLAYER_SCRIPT(keys=[f"user:{user_id}"])
+    return dict(zip(PLAYER_FIELDS, values))
+
+def decode_position(state):
+    # スナップショットにそれ以降の棋譜を再生した盤面・手番と、その局面の合法手
+    black, white = decode_board(state["board"]) if state["board"] else engine.initial()
+    turn = state["turn"] or "black"
+    if state.get("log"):
+        black, white, value, legal = movelog.replay(state["log"], black, white, color_value(turn))
+        return black, white, color_name(value), legal
+    if state["legal"] is not None:
+        legal = int(state["legal"])
+    else:
+        legal = engine.legal_moves(*engine.split(black, white, color_value(turn)))
+    return black, white, turn, legal
+
+def position_ply(state):
+    # 現在の手数（スナップショットの手数 + その後の棋譜の長さ）
+    return int(state.get("ply") or 0) + len(state.get("log") or "")
+
+async def load_moves(game_id, player, ply):
+    # ply 手目以降の棋譜。load_player で読んだ分で足りなければ Redis から読む
+    snapshot = int(player["ply"] or 0)
+    if ply >= snapshot:
+        return (player["log"] or "")[ply - snapshot:]
+    return await rdb.getrange(moves_key(game_id), ply + movelog.HEADER, -1)
+
+def position_mapping(black, white, turn, legal, ply=0):
+    return {
+        "board": encode_board(black, white),
+        "turn": turn,
+        "legal": legal,
+        "ply": ply,
+    }
+
+def create_game(pipe, game_id, black, white, turn, legal):
+    # 初期局面のスナップショットと、先手だけを記録した棋譜
+    pipe.hset(game_key(game_id), mapping=position_mapping(black, white, turn, legal))
+    pipe.expire(game_key(game_id), GAME_TTL)
+    pipe.set(moves_key(game_id), movelog.header(color_value(turn)), ex=GAME_TTL)
+
+# 着手を棋譜に追記し、前回のスナップショットから SNAPSHOT_EVERY 手以上進んでいれば
+# 盤面も保存する。ARGV は (追記する手, board, turn, legal, 間隔, TTL)。戻り値は手数
+RECORD_SCRIPT = rdb.register_script("""
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    -- 棋譜の導入前から続いている対局は、先手不明の見出しから記録する
+    redis.call('SET', KEYS[2], '-')
+end
+local ply = redis.call('APPEND', KEYS[2], ARGV[1]) - 1
+redis.call('EXPIRE', KEYS[2], ARGV[6])
+local snapshot = tonumber(redis.call('HGET', KEYS[1], 'ply')) or 0
+if ply - snapshot >= tonumber(ARGV[5]) then
+    redis.call('HSET', KEYS[1], 'board', ARGV[2], 'turn', ARGV[3], 'legal', ARGV[4], 'ply', ply)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[6])
+return ply
+""")
+
+def record_args(entries, black, white, turn, legal):
+    return [entries, encode_board(black, white), turn, legal, SNAPSHOT_EVERY, GAME_TTL]
+
+async def save_position(game_id, black, white, turn, legal, entry):
+    # 着手（movelog の 1 文字）を棋譜に追記して Redis に保存（再接続対応）し、手数を返す。
+    # このワーカーでキャッシュ中の対局は session_flusher がまとめて書き出す
+    session = sessions.get(game_id)
+    if session is not None:
+        session.update(black, white, turn, legal, entry)
+        return session.ply
+    with metrics.REDIS_LATENCY.labels("record").time():
+        return await RECORD_SCRIPT(keys=[game_key(game_id), moves_key(game_id)],
+                                   args=record_args(entry, black, white, turn, legal))
+
+@app.get("/games/{game_id}/record")
+async def game_record(game_id: str, ply: int | None = None):
+    # 棋譜と、ply 手目（省略時は最新）まで再生した局面
+    record = await rdb.get(moves_key(game_id))
+    if not record or record[0] not in "bw":
+        raise HTTPException(status_code=404, detail="record not found")
+    first, log = movelog.parse(record)
+    ply = len(log) if ply is None else max(0, min(ply, len(log)))
+    black, white, color, legal = movelog.replay(log, color=first, ply=ply)
+    return {
+        "game_id": game_id,
+        "first_turn": color_name(first),
+        "moves": movelog.moves(log),
+        "ply": ply,
+        "board": engine.to_list(black, white),
+        "turn": color_name(color),
+        "legal_moves": moves_list(legal),
+    }
+
+@app.post("/analysis")
+async def analysis_endpoint(request: Request, authorization: str | None = Header(None)):
+    # 局面・棋譜をまとめて解析する（形式は analysis.py の先頭を参照）
+    if not ANALYSIS_TOKEN:
+        raise HTTPException(status_code=404, detail="analysis is disabled (set ANALYSIS_TOKEN)")
+    check_token(ANALYSIS_TOKEN, authorization)
+    # 解析は全コアを使うので、同時に受けるのは ANALYSIS_MAX_CONCURRENT 件まで
+    if analysis_slots.locked():
+        raise HTTPException(status_code=429, detail="analysis is busy")
+    async with analysis_slots:
+        # 2 万局面だと JSON の読み込み・検証・整形がそれぞれ 0.3 秒ほどかかるので、イベントループの外で行う
+        body = await request.body()
+        loop = asyncio.get_running_loop()
+        try:
+            positions, records, level, time_budget = await loop.run_in_executor(
+                None, lambda: analysis.parse_request(json.loads(body), ANALYSIS_MAX_POSITIONS,
+                                                     ANALYSIS_MAX_SEARCH_SECONDS))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        started = time.perf_counter()
+        results = await analyzer.analyze(positions, level, time_budget)
+        logging.info(f"[ANALYSIS] {len(positions)} 局面を {time.perf_counter() - started:.2f} 秒で解析しました")
+        content = await loop.run_in_executor(
+            None, lambda: json.dumps(analysis.format_response(positions, records, level, results)))
+    return Response(content, media_type="application/json")
+
+def attached(user_id, opponent_id):
+    # 両プレイヤーがこのワーカーに接続しているか（CPU 戦はプレイヤーのみ）
+    return user_id in connected_sockets and (opponent_id == "cpu" or opponent_id in connected_sockets)
+
+async def get_session(user_id):
+    session = sessions.for_user(user_id)
+    if session is not None:
+        return session
+
+    player = await load_player(user_id)
+    game_id = player["game_id"]
+    if not game_id or player["status"] != "matched":
+        logging.info(f"[SESSION] {user_id} は対局中ではありません")
+        return None
+    black, white, turn, legal = decode_position(player)
+    color = player["color"]
+    opponent_id = player["opponent"]
+    session = GameSession(
+        game_id, black, white, turn, legal,
+        [(user_id, color), (opponent_id, "black" if color == "white" else "white")],
+        {user_id: player["name"], opponent_id: player["opponent_name"]},
+        player["cpu_level"], position_ply(player))
+    if attached(user_id, opponent_id):
+        sessions.add(session)
+    return session
+
+async def release_session(user_id):
+    # 切断・終局・降参時はキャッシュを即座に書き出して外す
+    session = sessions.for_user(user_id)
+    if session is not None:
+        sessions.remove(session.game_id)
+        if session.dirty:
+            await flush_sessions([session])
+
+async def flush_sessions(to_write):
+    # 書き出す内容は await の前に確定させる（書き出し中の着手は次回に回る）
+    writes = []
+    for session in to_write:
+        writes.append((session, session.pending, record_args(
+            session.pending, session.black, session.white, session.turn, session.legal)))
+        session.pending = ""
+        session.dirty = False
+    if not writes:
         return
-
-    # 2人をランダムに選ぶ
-    candidates = [uid for uid in waiting_users if uid != current_id]
-    if not candidates:
+    try:
+        async with rdb.pipeline(transaction=False) as pipe:
+            for session, _, args in writes:
+                await RECORD_SCRIPT(keys=[game_key(session.game_id), moves_key(session.game_id)],
+                                    args=args, client=pipe)
+            with metrics.REDIS_LATENCY.labels("flush").time():
+                await pipe.execute()
+    except Exception:
+        for session, pending, _ in writes:
+            session.pending = pending + session.pending
+            session.dirty = True
+        raise
+
+async def session_flusher():
+    # dirty な対局を SESSION_FLUSH_INTERVAL ごとに 1 回のパイプラインで書き出す
+    while True:
+        await asyncio.sleep(SESSION_FLUSH_INTERVAL)
+        try:
+            await flush_sessions(sessions.dirty())
+        except Exception as e:
+            logging.warning(f"[WARN] 対局キャッシュの書き出しに失敗: {e}")
+
+async def play_move(game_id, players, black, white, color, sq):
+    # 合法手 sq を打って保存し、players [(user_id, color), ...] に通知する。
+    # 次の手番に合法手がなければ自動でパスを通知する。終局なら next_turn は None
+    value = color_value(color)
+    player, opponent = engine.play(*engine.split(black, white, value), sq)
+    black, white = engine.join(player, opponent, value)
+    next_value, legal = engine.advance(black, white, value)
+    next_turn = color_name(next_value)
+    other = "black" if color == "white" else "white"
+
+    ply = await save_position(game_id, black, white, next_turn or other, legal, movelog.encode(sq))
+
+    # 座標と色、次のターン、手数を通知（board は送らない）
+    x, y = engine.coords(sq)
+    legal_moves = moves_list(legal)
+    await fan_out(router.send(uid, {
+        "type": "move",
+        "x": x,
+        "y": y,
+        "color": color,
+        "next_turn": next_turn or other,
+        "your_color": c,
+        "your_turn": (next_turn == c),
+        "legal_moves": legal_moves,
+        "ply": ply
+    }) for uid, c in players)
+    broadcast(game_id, ply, {"type": "move", "x": x, "y": y, "color": color,
+                             "next_turn": next_turn or other, "ply": ply})
+
+    if next_turn == color:
+        logging.info(f"[PASS] {other} に合法手がないため自動パス")
+        await fan_out(router.send(uid, {
+            "type": "pass",
+            "color": other,
+            "next_turn": next_turn,
+            "your_color": c,
+            "your_turn": (next_turn == c),
+            "legal_moves": legal_moves,
+            "ply": ply
+        }) for uid, c in players)
+        broadcast(game_id, ply, {"type": "pass", "color": other, "next_turn": next_turn, "ply": ply})
+
+    return black, white, next_turn, legal
+
+async def cpu_reply(game_id, players, black, white, cpu_color, turn, legal, level=None):
+    # CPU の手番が続く間（相手の自動パスを含む）打ち続ける
+    while turn == cpu_color:
+        sq = await cpu_pool.choose_move(black, white, color_value(cpu_color), legal,
+                                        level or cpu.DEFAULT_LEVEL, CPU_TIME_BUDGET)
+        black, white, turn, legal = await play_move(game_id, players, black, white, cpu_color, sq)
+    return black, white, turn, legal
+
+async def cpu_turn(user_id, game_id, players, black, white, cpu_color, legal, level):
+    try:
+        _, _, turn, _ = await cpu_reply(game_id, players, black, white, cpu_color, cpu_color, legal, level)
+        if turn is None:
+            await finish_game(user_id)
+    except asyncio.CancelledError:
+        logging.info(f"[CPU] {user_id} の CPU 手番をキャンセルしました")
+        raise
+    except Exception as e:
+        logging.warning(f"[WARN] CPU の応答に失敗: {e}")
+    finally:
+        if cpu_tasks.get(user_id) is asyncio.current_task():
+            cpu_tasks.pop(user_id, None)
+
+def start_cpu_turn(user_id, game_id, players, black, white, cpu_color, legal, level):
+    cancel_cpu_turn(user_id)
+    cpu_tasks[user_id] = asyncio.create_task(
+        cpu_turn(user_id, game_id, players, black, white, cpu_color, legal, level))
+
+def cancel_cpu_turn(user_id):
+    task = cpu_tasks.pop(user_id, None)
+    if task:
+        task.cancel()
+
+async def finish_game(user_id):
+    # 終局していなければ何もしない（クライアントの end_game で途中の石数のまま
+    # レーティングが決まらないよう、盤面で確かめる）
+    session = sessions.for_user(user_id)
+    if session is not None and not game_over(session.black, session.white):
+        logging.info(f"[END] {user_id} の end_game は終局前のため無視します")
+        return
+    await release_session(user_id)
+    player = await load_player(user_id)
+    opponent_id = player["opponent"]
+    if not opponent_id:
+        # 既に相手側の end_game で処理済み
+        return
+    game_id = player["game_id"]
+    black, white, turn, _ = decode_position(player)
+    if not game_over(black, white):
+        logging.info(f"[END] {user_id} の end_game は終局前のため無視します")
         return
-    
-    
-    opponent_id = random.choice(candidates)
-    user_ids = [current_id, opponent_id]
-    random.shuffle(user_ids)
-    user1_id, user2_id = user_ids[0], user_ids[1]
 
-    user1_name = await rdb.hget(f"user:{user1_id}", "name")
-    user2_name = await rdb.hget(f"user:{user2_id}", "name")
+    my_color = player["color"]
+    opponent_color = "black" if my_color == "white" else "white"
 
-    
+    # 石数で勝敗を決めてレーティングを更新
+    mine, theirs = engine.split(black, white, color_value(my_color))
+    if mine.bit_count() >= theirs.bit_count():
+        await update_ratings(game_id, user_id, opponent_id, mine.bit_count() == theirs.bit_count())
+    else:
+        await update_ratings(game_id, opponent_id, user_id)
+
+    # 再接続用に有効期限を延長し、状態を waiting に戻す
+    async with rdb.pipeline(transaction=False) as pipe:
+        pipe.expire(game_key(game_id), 40)
+        pipe.expire(moves_key(game_id), RECORD_TTL)
+        pipe.hset(f"user:{user_id}", mapping={"status": "waiting", "opponent": ""})
+        if opponent_id != "cpu":
+            pipe.hset(f"user:{opponent_id}", mapping={"status": "waiting", "opponent": ""})
+        await pipe.execute()
+
+    await fan_out(router.send(uid, {
+        "type": "end_game",
+        "current_player": 1 if turn == "black" else -1,
+        "your_color": color,
+        "opponent_name":opponent_name
+    }, board=(black, white)) for uid, color, opponent_name in [
+         (user_id, my_color, player["opponent_name"]),
+         (opponent_id, opponent_color, player["name"])
+    ])
+    broadcast(game_id, None, {"type": "end_game", "current_player": 1 if turn == "black" else -1,
+                              "black": black.bit_count(), "white": white.bit_count()})
+
+# 待機キューは mode ごとに 2 つの sorted set で持つ。
+#   queue:{mode}        スコアは待機開始時刻（古い順に相手を探す）
+#   queue:{mode}:rating スコアはレーティング（±R の相手を範囲検索で探す）
+# 古い順に最大 4 * 組数 人を見て、各人の許容幅 R（待ち時間に応じて広がる）内で
+# 最もレーティングが近い待機者と組み、両者の user ハッシュまで原子的に更新する。
+# ARGV は (現在時刻, 初期幅, 幅の広がる速さ/秒, 最大幅, mode) のあとに
+# 組ごとの (game_id, 色を入れ替えるか "0"/"1")。待機中でなくなったユーザーは捨てる。
+# キューが空になった mode は KEYS[3]（queue:modes）から外す（enqueue_waiting が入れ直す）。
+# 戻り値は組ごとに (黒, 白, game_id, 黒の名前, 白の名前, レーティング差,
+# 黒の待ち時間, 白の待ち時間) を並べたもの
+PAIR_SCRIPT = rdb.register_script("""
+local queue = KEYS[1]
+local by_rating = KEYS[2]
+local now = tonumber(ARGV[1])
+local base = tonumber(ARGV[2])
+local widen = tonumber(ARGV[3])
+local max_window = tonumber(ARGV[4])
+local max_pairs = (#ARGV - 5) / 2
+
+local function drop(uid)
+    redis.call('ZREM', queue, uid)
+    redis.call('ZREM', by_rating, uid)
+end
+
+local function waiting(uid)
+    return redis.call('HGET', 'user:' .. uid, 'status') == 'waiting'
+end
+
+local result = {}
+local made = 0
+local oldest = redis.call('ZRANGE', queue, 0, max_pairs * 4 - 1, 'WITHSCORES')
+for i = 1, #oldest, 2 do
+    if made >= max_pairs then
+        break
+    end
+    local uid = oldest[i]
+    local rating = redis.call('ZSCORE', by_rating, uid)
+    if rating and not waiting(uid) then
+        drop(uid)
+    elseif rating then
+        rating = tonumber(rating)
+        local waited = now - tonumber(oldest[i + 1])
+        local window = math.min(base + widen * waited, max_window)
+        local best, best_diff
+        local above = redis.call('ZRANGEBYSCORE', by_rating, rating, rating + window, 'WITHSCORES', 'LIMIT', 0, 8)
+        local below = redis.call('ZREVRANGEBYSCORE', by_rating, rating, rating - window, 'WITHSCORES', 'LIMIT', 0, 8)
+        for _, candidates in ipairs({above, below}) do
+            for j = 1, #candidates, 2 do
+                local c = candidates[j]
+                local diff = math.abs(tonumber(candidates[j + 1]) - rating)
+                if c ~= uid and (not best or diff < best_diff) and waiting(c) then
+                    best, best_diff = c, diff
+                end
+            end
+        end
+        if best then
+            made = made + 1
+            local best_waited = now - tonumber(redis.call('ZSCORE', queue, best) or now)
+            drop(uid)
+            drop(best)
+            local u1, u2, w1, w2 = uid, best, waited, best_waited
+            if ARGV[5 + 2 * made] == '1' then
+                u1, u2, w1, w2 = u2, u1, w2, w1
+            end
+            local game_id = ARGV[4 + 2 * made]
+            local name1 = redis.call('HGET', 'user:' .. u1, 'name') or ''
+            local name2 = redis.call('HGET', 'user:' .. u2, 'name') or ''
+            redis.call('HSET', 'user:' .. u1, 'game_id', game_id, 'status', 'matched',
+                       'opponent', u2, 'color', 'black', 'opponent_name', name2)
+            redis.call('HSET', 'user:' .. u2, 'game_id', game_id, 'status', 'matched',
+                       'opponent', u1, 'color', 'white', 'opponent_name', name1)
+            for _, v in ipairs({u1, u2, game_id, name1, name2,
+                                tostring(best_diff), tostring(w1), tostring(w2)}) do
+                table.insert(result, v)
+            end
+        end
+    end
+end
+if redis.call('ZCARD', queue) == 0 then
+    redis.call('SREM', KEYS[3], ARGV[5])
+end
+return result
+""")
+
+def queue_key(mode):
+    return f"queue:{mode or 'online'}"
+
+async def get_rating(user_id):
+    value = await rdb.hget("ratings", user_id)
+    return float(value) if value else rating.DEFAULT_RATING
+
+async def enqueue_waiting(user_id, mode):
+    # 既に並んでいる場合は待機開始時刻を維持する
+    key = queue_key(mode)
+    user_rating = await get_rating(user_id)
+    async with rdb.pipeline(transaction=True) as pipe:
+        pipe.zadd(key, {user_id: time.time()}, nx=True)
+        pipe.zadd(f"{key}:rating", {user_id: user_rating}, nx=True)
+        pipe.sadd("queue:modes", mode or "online")
+        with metrics.REDIS_LATENCY.labels("enqueue").time():
+            await pipe.execute()
+
+# user ハッシュの mode の待機キューから外す（queue_key と同じキー）
+DEQUEUE_SCRIPT = rdb.register_script("""
+local mode = redis.call('HGET', KEYS[1], 'mode')
+if not mode or mode == '' then
+    mode = 'online'
+end
+redis.call('ZREM', 'queue:' .. mode, ARGV[1])
+redis.call('ZREM', 'queue:' .. mode .. ':rating', ARGV[1])
+""")
+
+async def dequeue_waiting(user_id):
+    await DEQUEUE_SCRIPT(keys=[f"user:{user_id}"], args=[user_id])
+
+async def update_ratings(game_id, winner_id, loser_id, draw=False):
+    # 1 局につき 1 回だけ更新する（両者の end_game が重なっても二重に数えない）
+    if "cpu" in (winner_id, loser_id) or not (winner_id and loser_id):
+        return
+    if not await rdb.set(f"rated:{game_id}", 1, nx=True, ex=3600):
+        return
+    winner_rating, loser_rating = rating.update(
+        await get_rating(winner_id), await get_rating(loser_id), draw)
+    await rdb.hset("ratings", mapping={winner_id: winner_rating, loser_id: loser_rating})
+    logging.info(f"[RATING] {winner_id}={winner_rating:.0f}, {loser_id}={loser_rating:.0f}")
+
+async def matchmaker():
+    # マッチングはこの 1 タスクだけが行う。MATCH_WINDOW 秒ごとに
+    # 待機キューから最大 MATCH_BATCH_SIZE 組ずつまとめて成立させる
+    while True:
+        await asyncio.sleep(MATCH_WINDOW)
+        if draining:
+            continue
+        try:
+            for mode in await rdb.smembers("queue:modes"):
+                while await match_batch(mode) == MATCH_BATCH_SIZE:
+                    pass
+        except Exception as e:
+            logging.warning(f"[WARN] matchmaker のエラー: {e}")
+
+async def match_batch(mode):
+    key = queue_key(mode)
+    args = [time.time(), MATCH_RATING_WINDOW, MATCH_WINDOW_WIDEN, MATCH_MAX_RATING_WINDOW, mode]
+    for _ in range(MATCH_BATCH_SIZE):
+        args += [str(uuid.uuid4()), random.choice("01")]
+    with metrics.REDIS_LATENCY.labels("pair").time():
+        result = await PAIR_SCRIPT(keys=[key, f"{key}:rating", "queue:modes"], args=args)
+
+    pairs = [result[i:i + 8] for i in range(0, len(result), 8)]
+    for pair in pairs:
+        metrics.MATCHES.inc()
+        metrics.MATCH_RATING_DIFF.observe(float(pair[5]))
+        metrics.MATCH_WAIT.observe(float(pair[6]))
+        metrics.MATCH_WAIT.observe(float(pair[7]))
+    await asyncio.gather(*(start_match(*pair[:5]) for pair in pairs))
+    return len(pairs)
+
+async def start_match(user1_id, user2_id, game_id, user1_name, user2_name):
     user1_color = "black"
     user2_color = "white"
     first_turn = "black"
-    
-    
-    game_id = str(uuid.uuid4())
-
-    await rdb.hset(f"user:{user1_id}", mapping={
-            "game_id": game_id,
-            "status": "matched",
-            "opponent": user2_id,
-            "color": user1_color,
-            "opponent_name": user2_name
-    })
-    await rdb.hset(f"user:{user2_id}", mapping={
-            "game_id": game_id,
-            "status": "matched",
-            "opponent": user1_id,
-            "color": user2_color,
-            "opponent_name": user1_name
-    })
 
     logging.info(f"[MATCH] {user1_id} ({user1_color}) vs {user2_id} ({user2_color})")
 
-    await asyncio.sleep(2.0)
-
-    board = save_board()
-
-    if user1_id in connected_sockets:
-        await connected_sockets[user1_id].send_text(json.dumps({
-            "type": "start_game",
-            "your_color": user1_color,
-            "opponent_name": user2_name,
-            "first_turn": first_turn,
-            "board": board
-        }))
-    else:
-        logging.warning(f"[try_match] user1_id {user1_id} がconnected_socketsに存在しません")
-
-    if user2_id in connected_sockets:
-        await connected_sockets[user2_id].send_text(json.dumps({
-            "type": "start_game",
-            "your_color": user2_color,
-            "opponent_name": user1_name,
-            "first_turn": first_turn,
-            "board": board
-        }))
-    else:
-         logging.warning(f"[try_match] user2_id {user2_id} がconnected_socketsに存在しません")
-
-    
-
-    await rdb.set(f"board:{game_id}", json.dumps(board), ex=3600)
-    
-    await rdb.set(f"turn:{game_id}", first_turn, ex=3600)
-
-async def start_cpu_game(user_id):
-    logging.info(f"[CPU] {user_id} と CPU の対戦を開始します")
-
-    # CPU対戦用にゲームIDを生成。今はいらない）
-    #game_id = str(uuid.uuid4())
+    black, white = engine.initial()
+    legal = engine.legal_moves(*engine.split(black, white, color_value(first_turn)))
+    async with rdb.pipeline(transaction=True) as pipe:
+        create_game(pipe, game_id, black, white, first_turn, legal)
+        await pipe.execute()
+    if attached(user1_id, user2_id):
+        sessions.add(GameSession(
+            game_id, black, white, first_turn, legal,
+            [(user1_id, user1_color), (user2_id, user2_color)],
+            {user1_id: user1_name, user2_id: user2_name}))
+
+    entries = [
+        (user1_id, user1_color, user2_name),
+        (user2_id, user2_color, user1_name)
+    ]
+    sent = await fan_out(router.send(uid, {
+        "type": "start_game",
+        "your_color": color,
+        "opponent_name": opponent_name,
+        "first_turn": first_turn,
+        "legal_moves": moves_list(legal),
+        "ply": 0
+    }, board=(black, white)) for uid, color, opponent_name in entries)
+    for (uid, _, _), ok in zip(entries, sent):
+        if ok is False:
+            logging.warning(f"[MATCH] {uid} はどのワーカーにも接続していません")
+
+async def start_cpu_game(user_id, name, level=None):
+    level = level or cpu.DEFAULT_LEVEL
+    logging.info(f"[CPU] {user_id} と CPU（{level}）の対戦を開始します")
+
+    # CPU対戦用にゲームIDを生成（盤面・合法手の保存に使う）
+    game_id = str(uuid.uuid4())
 
     # プレイヤーの色をランダムに決定
     user_color = random.choice(["black", "white"])
+    cpu_color = "black" if user_color == "white" else "white"
     
     first_turn = random.choice(["black", "white"])
 
-    # プレイヤー情報をRedisに保存（opponentは "cpu" 扱い）
-    await rdb.hset(f"user:{user_id}", mapping={
-        #"game_id": game_id,
-        "status": "matched",
-        "opponent": "cpu",
-        "color": user_color,
-        "opponent_name": "CPU"
-    })
-
-    # 初期盤面を保存
-    board = save_board()
-    #await rdb.set(f"board:{game_id}", json.dumps(board), ex=3600)
-    #await rdb.set(f"turn:{game_id}", first_turn, ex=3600)
-    
+    # プレイヤー情報（opponentは "cpu" 扱い）と初期盤面をまとめてRedisに保存
+    black, white = engine.initial()
+    legal = engine.legal_moves(*engine.split(black, white, color_value(first_turn)))
+    async with rdb.pipeline(transaction=True) as pipe:
+        pipe.hset(f"user:{user_id}", mapping={
+            "game_id": game_id,
+            "status": "matched",
+            "opponent": "cpu",
+            "color": user_color,
+            "opponent_name": "CPU",
+            "cpu_level": level
+        })
+        create_game(pipe, game_id, black, white, first_turn, legal)
+        await pipe.execute()
+    players = [(user_id, user_color), ("cpu", cpu_color)]
+    if attached(user_id, "cpu"):
+        sessions.add(GameSession(game_id, black, white, first_turn, legal, players,
+                                 {user_id: name, "cpu": "CPU"}, level))
 
     # プレイヤーにゲーム開始メッセージ送信
     if user_id in connected_sockets:
-        await connected_sockets[user_id].send_text(json.dumps({
+        connected_sockets[user_id].send({
             "type": "start_game",
             "your_color": user_color,
             "opponent_name": "CPU",
             "first_turn": first_turn,
-            "board": board
-        }))
+            "board": board_payload(user_id, black, white),
+            "legal_moves": moves_list(legal),
+            "ply": 0
+        })
         logging.info(f"[CPU] start_game sent to {user_id}")
     else:
         logging.warning(f"[CPU] {user_id} が connected_sockets に存在しません")
 
+    # CPU が先手ならそのまま打つ
+    if first_turn == cpu_color:
+        start_cpu_turn(user_id, game_id, players, black, white, cpu_color, legal, level)
+
 async def handle_disconnect(user_id):
-    
-    game_id = await rdb.hget(f"user:{user_id}", "game_id")
-    opponent_id = await rdb.hget(f"user:{user_id}", "opponent")
+    cancel_cpu_turn(user_id)
+    await release_session(user_id)
+    if draining:
+        # drain で書き出し・経路の削除まで済んでいる。猶予タイマーは引き継いだワーカーが持つ
+        connected_sockets.pop(user_id, None)
+        board_formats.pop(user_id, None)
+        return
+    await dequeue_waiting(user_id)
 
-    # userデータを完全には消さず、40秒だけ保持
-    await rdb.expire(f"user:{user_id}", 40)
-    await rdb.expire(f"board:{game_id}", 40)
-    await rdb.expire(f"turn:{game_id}", 40)
+    game_id, opponent_id = await rdb.hmget(f"user:{user_id}", "game_id", "opponent")
+
+    # userデータを完全には消さず、DISCONNECT_GRACE 秒だけ保持
+    # 対戦相手も猶予時間後にクリーンアップできるように更新
+    notify = opponent_id and await router.is_online(opponent_id, connected_sockets)
+    async with rdb.pipeline(transaction=False) as pipe:
+        pipe.expire(f"user:{user_id}", DISCONNECT_GRACE)
+        pipe.expire(game_key(game_id), DISCONNECT_GRACE)
+        if notify:
+            pipe.expire(f"user:{opponent_id}", DISCONNECT_GRACE)
+        await pipe.execute()
 
     connected_sockets.pop(user_id, None)
+    board_formats.pop(user_id, None)
+    await router.unregister(user_id)
 
-    if opponent_id and opponent_id in connected_sockets:
+    if notify:
         try:
-            await connected_sockets[opponent_id].send_text(json.dumps({
+            await router.send(opponent_id, {
                 "type": "opponent_disconnected"
-            }))
+            })
         except:
             pass
 
-        # 対戦相手も40秒後にクリーンアップできるように更新
-        await rdb.expire(f"user:{opponent_id}", 40)
-        await rdb.expire(f"board:{game_id}", 40)
-        await rdb.expire(f"turn:{game_id}", 40)
-
-        asyncio.create_task(wait_end(user_id, opponent_id))
-
-async def wait_end(disconnect_id, opponent_id):
-    await asyncio.sleep(40)
-    if disconnect_id not in connected_sockets:
-        print(f"[TIMEOUT]ユーザー {disconnect_id} が再接続しませんでした。")
-        game_id = await rdb.hget(f"user:{disconnect_id}", "game_id")
-        
-        board_data = await rdb.get(f"board:{game_id}")
-        turn = await rdb.get(f"turn:{game_id}")
-        color = await rdb.hget(f"user:{opponent_id}", "color")
+        grace_timers.schedule(user_id, DISCONNECT_GRACE, (user_id, opponent_id))
 
-        if board_data and turn and color and opponent_id in connected_sockets:
-            try:
-                await connected_sockets[opponent_id].send_text(json.dumps({
-                    "type": "end_game",
-                    "board": json.loads(board_data),
-                    "current_player": 1 if turn == "black" else -1,
-                    "your_color": color,
-                    
-                }))
-                logging.info(f"[END_GAME] {opponent_id} に対戦終了を通知しました。")
-            except Exception as e:
-                logging.info(f"[ERROR] end_game の送信失敗: {e}")
+async def expire_disconnects(entries):
+    # 猶予時間内に再接続しなかった切断 [(切断したユーザー, 相手), ...] をまとめて片付ける
+    online = await router.online([disconnect_id for disconnect_id, _ in entries], connected_sockets)
+    entries = [entry for entry, is_online in zip(entries, online) if not is_online]
+    if not entries:
+        return
 
-        await rdb.delete(f"user:{disconnect_id}")
-        await rdb.delete(f"user:{opponent_id}")
-        await rdb.delete(f"board:{game_id}")
-        
-        await rdb.delete(f"turn:{game_id}")
-       
-        logging.info(f"[CLEANUP] {disconnect_id} と {opponent_id} のデータを削除しました。")
+    async with rdb.pipeline(transaction=False) as pipe:
+        for _, opponent_id in entries:
+            await LOAD_PLAYER_SCRIPT(keys=[f"user:{opponent_id}"], client=pipe)
+        opponents = [dict(zip(PLAYER_FIELDS, values)) for values in await pipe.execute()]
+
+    sends = []
+    for (disconnect_id, opponent_id), opponent in zip(entries, opponents):
+        logging.info(f"[TIMEOUT] ユーザー {disconnect_id} が再接続しませんでした。")
+        broadcast(opponent["game_id"], None, {"type": "end_game", "reason": "disconnect"})
+        if opponent["board"] and opponent["turn"] and opponent["color"]:
+            black, white, turn, _ = decode_position(opponent)
+            sends.append(router.send(opponent_id, {
+                "type": "end_game",
+                "current_player": 1 if turn == "black" else -1,
+                "your_color": opponent["color"],
+            }, board=(black, white)))
+    await fan_out(sends)
+
+    # 棋譜は RECORD_TTL の間残す
+    async with rdb.pipeline(transaction=False) as pipe:
+        for (disconnect_id, opponent_id), opponent in zip(entries, opponents):
+            pipe.delete(f"user:{disconnect_id}", f"user:{opponent_id}", game_key(opponent["game_id"]))
+            pipe.expire(moves_key(opponent["game_id"]), RECORD_TTL)
+        await pipe.execute()
+    logging.info(f"[CLEANUP] {len(entries)} 件の切断した対局のデータを削除しました。")
+
+# 切断の猶予時間を 1 つのヒープで管理し、期限の来たものをまとめて expire_disconnects に渡す
+grace_timers = TimerScheduler(expire_disconnects)
+
+# 観戦
+#   {"type": "watch", "game_id": ..., "board_format": "packed"} で接続すると、まず
+#   restore_board（その時点の盤面と手数 ply）を送り、以降は move / pass / end_game の差分を送る。
+#   差分は対局ごとに 1 回だけシリアライズして全観戦者で共有する。別ワーカーの観戦者には
+#   watch:{game_id} チャンネルで BROADCAST_INTERVAL ごとにまとめて転送する。
+#   watchers ハッシュ（game_id -> 観戦者のいるワーカー数）で観戦中の対局だけを転送する。
+#   別ワーカーの観戦者は Redis から盤面を読むので、キャッシュ中の対局より古いことがある。
+#   対局をキャッシュしているワーカーは観戦するワーカーが増えたら盤面全体を送り、観戦側も
+#   差分の手数が飛んだら盤面を読み直して送り直す。
+
+def watch_channel(game_id):
+    return f"watch:{game_id}"
+
+# ワーカー数を 1 減らし、0 になったら消す
+UNWATCH_SCRIPT = rdb.register_script("""
+if redis.call('HINCRBY', KEYS[1], ARGV[1], -1) <= 0 then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+end
+""")
+
+def broadcast(game_id, ply, frame):
+    # 観戦者がいなければシリアライズもしない。ply は盤面の手数（終局など常に送るものは None）
+    local = game_id in spectators
+    remote = watched_games.get(game_id, 0) > local
+    if not local and not remote:
+        return
+    text = json.dumps({**frame, "game_id": game_id})
+    spectators.publish(game_id, ply, text)
+    if remote:
+        broadcast_buffer.append((game_id, ply, text))
+
+async def broadcast_flusher():
+    # 他ワーカー向けのフレームを 1 回のパイプラインで publish し、観戦中の対局の一覧を読み直す
+    previous = {}
+    while True:
+        await asyncio.sleep(BROADCAST_INTERVAL)
+        pending = broadcast_buffer[:]
+        broadcast_buffer.clear()
+        try:
+            async with rdb.pipeline(transaction=False) as pipe:
+                for game_id, ply, text in pending:
+                    pipe.publish(watch_channel(game_id),
+                                 f"{router.worker_id} {'-' if ply is None else ply} {text}")
+                pipe.hgetall("watchers")
+                watched = (await pipe.execute())[-1]
+            watched = {game_id: int(n) for game_id, n in watched.items()}
+            watched_games.clear()
+            watched_games.update(watched)
+            # 別ワーカーで観戦が始まったキャッシュ中の対局は、次の差分より先に盤面全体を送る
+            for game_id, n in watched.items():
+                session = sessions.get(game_id)
+                if session is not None and n > previous.get(game_id, 0) and n > (game_id in spectators):
+                    broadcast_buffer.append((game_id, f"={session.ply}",
+                                             json.dumps([session.black, session.white, session.turn])))
+            previous = watched
+        except Exception as e:
+            logging.warning(f"[WARN] 観戦フレームの転送に失敗: {e}")
+
+def spectator_restore(game_id, black, white, turn, ply, packed):
+    return {
+        "type": "restore_board",
+        "game_id": game_id,
+        "board": encode_board(black, white) if packed else engine.to_list(black, white),
+        "current_player": turn,
+        "ply": ply,
+        "spectator": True
+    }
+
+def publish_snapshot(game_id, black, white, turn, ply):
+    # このワーカーの観戦者に盤面全体を送り直す（形式ごとに 1 回だけシリアライズする）
+    spectators.publish(game_id, ply,
+                       json.dumps(spectator_restore(game_id, black, white, turn, ply, False)),
+                       json.dumps(spectator_restore(game_id, black, white, turn, ply, True)))
+
+def resync_spectators(game_id):
+    if game_id not in resync_tasks:
+        resync_tasks[game_id] = asyncio.create_task(resync_game(game_id))
+
+async def resync_game(game_id, attempts=5):
+    # 受け取った差分より新しい盤面が読めたら送り直す。Redis はキャッシュ中の対局より
+    # SESSION_FLUSH_INTERVAL ほど遅れるので、追いつくまで数回読み直す
+    try:
+        for attempt in range(attempts):
+            if attempt:
+                await asyncio.sleep(SESSION_FLUSH_INTERVAL)
+            state = await load_game(game_id)
+            latest = spectators.latest(game_id)
+            if state is None or latest is None:
+                return
+            if state[3] >= latest:
+                publish_snapshot(game_id, *state)
+                logging.info(f"[WATCH] {game_id} の観戦者に {state[3]} 手目の盤面を送り直しました")
+                return
+        logging.warning(f"[WATCH] {game_id} の盤面を送り直せませんでした")
+    except Exception as e:
+        logging.warning(f"[WARN] 観戦者の盤面の再送に失敗: {e}")
+    finally:
+        resync_tasks.pop(game_id, None)
+
+async def load_game(game_id):
+    # 観戦開始時の盤面・手番・手数（このワーカーでキャッシュ中ならそれを使う）
+    session = sessions.get(game_id)
+    if session is not None:
+        return session.black, session.white, session.turn, session.ply
+    async with rdb.pipeline(transaction=False) as pipe:
+        pipe.hmget(game_key(game_id), "board", "turn", "legal", "ply")
+        pipe.get(moves_key(game_id))
+        (board, turn, legal, ply), record = await pipe.execute()
+    if not board:
+        return None
+    state = {"board": board, "turn": turn, "legal": legal, "ply": ply,
+             "log": (record or "")[movelog.HEADER + int(ply or 0):]}
+    black, white, turn, _ = decode_position(state)
+    return black, white, turn, position_ply(state)
+
+async def watch_game(websocket, conn, limits, init_data):
+    game_id = init_data.game_id
+    packed = init_data.board_format == "packed"
+    conn.max_queue = SPECTATOR_OUTBOX
+
+    # 盤面を読んでいる間に届いたフレームも取りこぼさないよう、先に購読する
+    if spectators.open(game_id):
+        await router.watch(watch_channel(game_id))
+        watched_games[game_id] = await rdb.hincrby("watchers", game_id, 1)
+    joined = False
+    try:
+        state = await load_game(game_id)
+        if state is None:
+            conn.send({"type": "error", "reason": "game_not_found", "game_id": game_id})
+            await conn.shutdown(1008)
+            return
+        black, white, turn, ply = state
+        conn.send(spectator_restore(game_id, black, white, turn, ply, packed))
+        joined = spectators.join(game_id, conn, ply, packed)
+        if not joined:
+            conn.send({"type": "error", "reason": "too_many_spectators", "game_id": game_id})
+            await conn.shutdown(1013)
+            return
+        logging.info(f"[WATCH] {game_id} の観戦を開始（このワーカーで {len(spectators)} 人）")
+
+        # 観戦者からのメッセージは読み捨てる（サイズ・レート制限はかける）
+        while True:
+            await receive_message(websocket, conn, limits)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if spectators.leave(game_id, conn if joined else None):
+            await router.unwatch(watch_channel(game_id))
+            await UNWATCH_SCRIPT(keys=["watchers"], args=[game_id])
+
+# ローリングデプロイ
+#   drain: 新しい接続・マッチング・着手を止め、キャッシュ中の対局を 1 回のパイプラインで
+#     書き出したあと、接続中のユーザーの経路と待機キューを消して（データには HANDOFF_TTL を
+#     付けて残す）、全接続に reconnect（retry_after は 0〜RECONNECT_SPREAD 秒でばらつかせる）を
+#     送ってから 1012 で閉じる。猶予時間を待つ切断扱いにはしない。
+#   restore_handoff: WORKER_NAME が同じワーカーが残した引き継ぎ情報を起動時に読み、
+#     戻ってくるユーザー（別のワーカーに再接続済みの人は除く）の状態を 1 回のパイプラインで
+#     先読みし、猶予タイマーを張り直す。
+
+def handoff_keys():
+    return f"handoff:{WORKER_NAME}:users", f"handoff:{WORKER_NAME}:timers"
+
+def reconnect_notice():
+    return {"type": "reconnect", "reason": "server_restart",
+            "retry_after": round(random.uniform(0, RECONNECT_SPREAD), 2)}
+
+async def drain():
+    # 閉じた接続の数を返す（2 回目以降は何もしない）
+    global draining
+    if draining:
+        return 0
+    draining = True
+    logging.info(f"[DRAIN] 新しい接続とマッチングを停止しました（接続 {len(open_connections)}、対局 {len(sessions)}）")
+    for user_id in list(cpu_tasks):
+        cancel_cpu_turn(user_id)
+
+    cached = sessions.all()
+    for session in cached:
+        sessions.remove(session.game_id)
+    await flush_sessions([session for session in cached if session.dirty])
+
+    users = list(connected_sockets)
+    timers = grace_timers.pending()
+    now = time.time()
+    async with rdb.pipeline(transaction=False) as pipe:
+        for user_id in users:
+            await DEQUEUE_SCRIPT(keys=[f"user:{user_id}"], args=[user_id], client=pipe)
+            pipe.expire(f"user:{user_id}", HANDOFF_TTL)
+        await router.unregister_many(users, pipe)
+        if WORKER_NAME:
+            users_key, timers_key = handoff_keys()
+            if users:
+                pipe.sadd(users_key, *users)
+                pipe.expire(users_key, HANDOFF_TTL)
+            if timers:
+                # 期限は時刻で残す（payload は (切断したユーザー, 相手)）
+                pipe.hset(timers_key, mapping={
+                    key: json.dumps([payload[1], now + remaining]) for key, remaining, payload in timers
+                })
+                pipe.expire(timers_key, HANDOFF_TTL)
+        await pipe.execute()
+
+    conns = list(open_connections)
+    for conn in conns:
+        conn.send(reconnect_notice())
+    await asyncio.gather(*(conn.shutdown(1012) for conn in conns), return_exceptions=True)
+    logging.info(f"[DRAIN] {len(conns)} 件の接続に再接続を促して閉じました（引き継ぎ: ユーザー {len(users)}、"
+                 f"猶予タイマー {len(timers)}）")
+    return len(conns)
+
+def install_sigterm_drain():
+    # uvicorn は SIGTERM を受けると全 WebSocket を 1012 で閉じ、ハンドラが終わるのを待ってから
+    # shutdown イベントを呼ぶ（そこで drain しても、接続は通常の切断として片付いた後になる）。
+    # SIGTERM を先に受け取って drain を済ませてから、uvicorn のハンドラに渡す
+    if threading.current_thread() is not threading.main_thread():
+        return
+    loop = asyncio.get_running_loop()
+    previous = signal.getsignal(signal.SIGTERM)
 
-    
+    async def drain_then_exit(sig, frame):
+        try:
+            await drain()
+        except Exception as e:
+            logging.warning(f"[DRAIN] 終了処理に失敗: {e}")
+        if callable(previous):
+            previous(sig, frame)
+        else:
+            signal.signal(sig, previous)
+            signal.raise_signal(sig)
+
+    def on_sigterm(sig, frame):
+        loop.call_soon_threadsafe(
+            lambda: background_tasks.append(asyncio.create_task(drain_then_exit(sig, frame))))
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+async def restore_handoff():
+    if not WORKER_NAME:
+        return
+    users_key, timers_key = handoff_keys()
+    async with rdb.pipeline(transaction=True) as pipe:
+        pipe.smembers(users_key)
+        pipe.hgetall(timers_key)
+        pipe.delete(users_key, timers_key)
+        users, timers, _ = await pipe.execute()
+    users = list(users)
+
+    # 先に経路を自分に向けておき、読み込んだ後に別のワーカーで対局が進んだら deliver で気づく。
+    # すでに別のワーカーに再接続したユーザーは引き継がない
+    users = await router.claim_many(users)
+    async with rdb.pipeline(transaction=False) as pipe:
+        for user_id in users:
+            await LOAD_PLAYER_SCRIPT(keys=[f"user:{user_id}"], client=pipe)
+        players = [dict(zip(PLAYER_FIELDS, values)) for values in await pipe.execute()]
+    opponents = {}
+    for user_id, player in zip(users, players):
+        if player["status"] is not None:
+            preloaded[user_id] = player
+        if player["status"] == "matched" and player["opponent"] not in (None, "", "cpu"):
+            opponents[user_id] = player["opponent"]
+
+    now = time.time()
+    for user_id, value in timers.items():
+        opponent_id, deadline = json.loads(value)
+        grace_timers.schedule(user_id, max(0.0, deadline - now), (user_id, opponent_id))
+    if users:
+        background_tasks.append(asyncio.create_task(release_handoff(users, opponents)))
+    logging.info(f"[HANDOFF] ユーザー {len(preloaded)} 人の状態と猶予タイマー {len(timers)} 件を引き継ぎました")
+
+async def release_handoff(users, opponents):
+    # 猶予時間内に戻ってこなかったユーザーの経路と先読みを消し、対局は切断と同じく片付ける。
+    # opponents は user_id -> 対人戦の相手
+    await asyncio.sleep(DISCONNECT_GRACE)
+    for user_id in users:
+        preloaded.pop(user_id, None)
+    # 経路が自分を指したままのユーザーだけ（別のワーカーに再接続していれば触らない）
+    missing = await router.owned([user_id for user_id in users
+                                  if user_id not in connected_sockets and user_id not in grace_timers])
+    await router.unregister_many(missing)
+    await expire_disconnects([(user_id, opponents[user_id]) for user_id in missing if user_id in opponents])
@@ -0,0 +1,80 @@
+# このワーカーで進行中の対局のキャッシュ
+#
+# 両プレイヤー（CPU 戦ならプレイヤー 1 人）がこのワーカーに接続している間は
+# GameSession が対局状態の正となり、Redis への書き込みは dirty な対局を
+# まとめて後から行う（write-behind）。切断・終局・降参時はその場で書き出して
+# キャッシュから外し、別ワーカーへの再接続では Redis から読み直す。
+
+
+class GameSession:
+    __slots__ = ("game_id", "black", "white", "turn", "legal", "players", "names", "cpu_level",
+                 "ply", "pending", "dirty")
+
+    def __init__(self, game_id, black, white, turn, legal, players, names, cpu_level=None, ply=0):
+        self.game_id = game_id
+        self.black = black
+        self.white = white
+        self.turn = turn
+        self.legal = legal
+        self.players = players   # [(user_id, color), (user_id, color)]
+        self.names = names       # user_id -> name
+        self.cpu_level = cpu_level
+        self.ply = ply
+        self.pending = ""        # まだ Redis の棋譜に追記していない手（movelog 形式）
+        self.dirty = False
+
+    def color_of(self, user_id):
+        for uid, color in self.players:
+            if uid == user_id:
+                return color
+        return None
+
+    def opponent_of(self, user_id):
+        for uid, _ in self.players:
+            if uid != user_id:
+                return uid
+        return None
+
+    def update(self, black, white, turn, legal, entry):
+        self.black = black
+        self.white = white
+        self.turn = turn
+        self.legal = legal
+        self.ply += 1
+        self.pending += entry
+        self.dirty = True
+
+
+class SessionStore:
+    def __init__(self):
+        self._games = {}
+        self._users = {}
+
+    def __len__(self):
+        return len(self._games)
+
+    def get(self, game_id):
+        return self._games.get(game_id)
+
+    def for_user(self, user_id):
+        return self._users.get(user_id)
+
+    def add(self, session):
+        self._games[session.game_id] = session
+        for uid, _ in session.players:
+            self._users[uid] = session
+
+    def remove(self, game_id):
+        session = self._games.pop(game_id, None)
+        if session is not None:
+            for uid, _ in session.players:
+                if self._users.get(uid) is session:
+                    del self._users[uid]
+        return session
+
+    def dirty(self):
+        # 書き出し待ちの対局
+        return [s for s in self._games.values() if s.dirty]
+
+    def all(self):
+        return list(self._games.values())
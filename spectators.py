@@ -0,0 +1,139 @@
+# 観戦者への一斉送信
+#
+# 対局ごとに BroadcastGroup を 1 つ持ち、着手などのフレームは一度だけシリアライズして
+# 全観戦者の送信キューに同じ文字列を積む。配るのはグループごとの送信タスクで、
+# 対局者の処理からはキューに積むだけなので、観戦者が多くても対局者は待たされない。
+# 観戦者の数はグループごとに上限を設け、送信が詰まった観戦者は Connection 側で切られる。
+# 盤面全体を送るフレーム（restore_board）は盤面の形式ごとに 2 通り用意して、観戦者の形式で送る。
+
+import asyncio
+from collections import deque
+
+# 何人に積むごとにイベントループに処理を返すか
+YIELD_EVERY = 256
+
+
+class BroadcastGroup:
+    def __init__(self, game_id, max_members, history=64):
+        self.game_id = game_id
+        self.max_members = max_members
+        # conn -> (送った盤面の手数, packed 形式か)。その手数までの差分は送らない
+        self.members = {}
+        self.joining = 0         # open したがまだ join していない観戦者の数
+        self.ply = None          # 受け取った盤面・差分の最新の手数
+        # 途中参加者が、読み込んだ盤面より後のフレームを取りこぼさないよう直近分を持つ
+        self.recent = deque(maxlen=history)
+        self._queue = deque()
+        self._ready = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def __len__(self):
+        return len(self.members)
+
+    def add(self, conn, ply, packed=False):
+        # ply 手目の盤面を送った conn を加える。満員なら False
+        if len(self.members) >= self.max_members:
+            return False
+        for frame_ply, text, packed_text in self.recent:
+            if frame_ply is None or frame_ply > ply:
+                conn.send_text(packed_text if packed and packed_text else text)
+        self.members[conn] = (ply, packed)
+        if self.ply is None or ply > self.ply:
+            self.ply = ply
+        return True
+
+    def remove(self, conn):
+        self.members.pop(conn, None)
+
+    def publish(self, ply, text, packed_text=None):
+        # ply は盤面の手数（終局などいつでも送るものは None）。packed_text は盤面全体を
+        # 送るフレームの packed 形式。差分の手数が飛んでいたら True（盤面を送り直すこと）
+        gap = (packed_text is None and ply is not None and self.ply is not None
+               and ply > self.ply + 1)
+        if ply is not None and (self.ply is None or ply > self.ply):
+            self.ply = ply
+        self.recent.append((ply, text, packed_text))
+        self._queue.append((ply, text, packed_text))
+        self._ready.set()
+        return gap
+
+    async def _run(self):
+        while True:
+            while not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+            ply, text, packed_text = self._queue.popleft()
+            for i, (conn, (since, packed)) in enumerate(list(self.members.items())):
+                if ply is not None and ply <= since:
+                    continue
+                if not conn.send_text(packed_text if packed and packed_text else text):
+                    self.members.pop(conn, None)
+                if i % YIELD_EVERY == YIELD_EVERY - 1:
+                    await asyncio.sleep(0)
+
+    def close(self):
+        self._task.cancel()
+
+
+class Spectators:
+    def __init__(self, max_per_game, history=64):
+        self.max_per_game = max_per_game
+        self.history = history
+        self._groups = {}
+
+    def __len__(self):
+        return sum(len(g) for g in self._groups.values())
+
+    def __bool__(self):
+        return bool(self._groups)
+
+    def __contains__(self, game_id):
+        return game_id in self._groups
+
+    def open(self, game_id):
+        # 観戦を始める前に呼ぶ（盤面を読む間に届いたフレームもグループに溜まる）。
+        # グループを新しく作ったら True
+        group = self._groups.get(game_id)
+        created = group is None
+        if created:
+            group = self._groups[game_id] = BroadcastGroup(game_id, self.max_per_game, self.history)
+        group.joining += 1
+        return created
+
+    def join(self, game_id, conn, ply, packed=False):
+        # open 済みのグループに加える。満員なら False（そのあと leave(game_id) を呼ぶこと）
+        group = self._groups[game_id]
+        if not group.add(conn, ply, packed):
+            return False
+        group.joining -= 1
+        return True
+
+    def leave(self, game_id, conn=None):
+        # conn=None は open したが join しなかった場合。
+        # 最後の 1 人が抜けてグループがなくなったら True
+        group = self._groups.get(game_id)
+        if group is None:
+            return False
+        if conn is None:
+            group.joining -= 1
+        else:
+            group.remove(conn)
+        if not group.members and not group.joining:
+            self._remove(game_id)
+            return True
+        return False
+
+    def _remove(self, game_id):
+        self._groups.pop(game_id).close()
+
+    def latest(self, game_id):
+        # グループが受け取った最新の手数（グループがなければ None）
+        group = self._groups.get(game_id)
+        return group.ply if group is not None else None
+
+    def publish(self, game_id, ply, text, packed_text=None):
+        # 差分の手数が飛んでいたら True
+        group = self._groups.get(game_id)
+        if group is not None:
+            return group.publish(ply, text, packed_text)
+        return False
@@ -0,0 +1,83 @@
+# まとめて発火するタイマー
+#
+# 切断の猶予時間などを、対局ごとに sleep するタスクではなく 1 つのヒープで管理する。
+# 期限の来たタイマーは resolution 秒ぶんまとめて取り出し、on_fire に一括で渡す
+# （Redis の後片付けを 1 回のパイプラインで行えるようにするため）。
+# キーごとに 1 つだけ持ち、同じキーで schedule し直すと前のものは取り消される。
+
+import asyncio
+import heapq
+import itertools
+import logging
+
+
+class TimerScheduler:
+    def __init__(self, on_fire, resolution=0.5, batch_size=500):
+        # on_fire(payloads) は期限の来たタイマーの payload のリストを受け取る coroutine
+        self.on_fire = on_fire
+        self.resolution = resolution
+        self.batch_size = batch_size
+        self._heap = []          # (期限, 連番, キー)
+        self._timers = {}        # キー -> (連番, payload)
+        self._seq = itertools.count()
+        self._wake = asyncio.Event()
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def schedule(self, key, delay, payload):
+        deadline = asyncio.get_running_loop().time() + delay
+        seq = next(self._seq)
+        self._timers[key] = (seq, payload)
+        heapq.heappush(self._heap, (deadline, seq, key))
+        if self._heap[0][1] == seq:
+            # 先頭が変わったら待ち時間を計算し直す
+            self._wake.set()
+
+    def cancel(self, key):
+        # 取り消したら True（ヒープからは発火時に読み飛ばす）
+        return self._timers.pop(key, None) is not None
+
+    def pending(self):
+        # 未発火のタイマー [(キー, 残り秒数, payload), ...]（終了時の引き継ぎ用）
+        now = asyncio.get_running_loop().time()
+        live = {}
+        for deadline, seq, key in self._heap:
+            timer = self._timers.get(key)
+            if timer is not None and timer[0] == seq:
+                live[key] = (key, max(0.0, deadline - now), timer[1])
+        return list(live.values())
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, seq, key = heapq.heappop(self._heap)
+            timer = self._timers.get(key)
+            if timer is not None and timer[0] == seq:
+                del self._timers[key]
+                due.append(timer[1])
+        return due
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wake.clear()
+            timeout = None
+            if self._heap:
+                # 期限の近いものが resolution 秒以内にまとまるよう少し遅らせて起きる
+                timeout = max(0.0, self._heap[0][0] - loop.time()) + self.resolution
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+                continue
+            except asyncio.TimeoutError:
+                pass
+
+            due = self._pop_due(loop.time())
+            for i in range(0, len(due), self.batch_size):
+                try:
+                    await self.on_fire(due[i:i + self.batch_size])
+                except Exception as e:
+                    logging.warning(f"[WARN] タイマー処理に失敗: {e}")